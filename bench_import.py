@@ -0,0 +1,69 @@
+# import time benchmark for the pipeline packages
+# run with: python bench_import.py
+# exits non-zero if importing a pipeline module pulls in a heavy dependency, or is slower than the budget
+import subprocess
+import sys
+
+# modules short lived workers/scripts import, and the heavy deps they must not load on import
+MODULES = {
+    'dn757657_data_endpoints.mongoDB': ['airflow', 'pandas', 'dotenv'],
+    'dn757657_data_endpoints.mongoArrow': ['pyarrow', 'pymongoarrow', 'pandas'],
+    'dn757657_data_endpoints.candleStore': ['pyarrow', 'pandas'],
+    'dn757657_data_endpoints.mongoParallel': ['pyarrow', 'pandas'],
+    'dn757657_data_endpoints.mongoRetention': ['pyarrow', 'pandas'],
+    'dn757657_data_endpoints.mongoPanel': ['pyarrow', 'pandas'],
+    'dn757657_crypto_num_sources.bitfin': ['bitfinex', 'pandas', 'requests', 'dotenv'],
+    'dn757657_crypto_num_sources.bitfinStream': ['bitfinex', 'pandas', 'websockets'],
+    'dn757657_fin_news_sources.newsfeeds': ['requests', 'pandas'],
+}
+
+BUDGET_S = 0.5  # generous, pymongo is the only thing left imported eagerly
+RUNS = 5
+
+PROBE = '''
+import sys, time
+t = time.perf_counter()
+import {module}
+print(time.perf_counter() - t)
+print(",".join(m for m in {heavy!r} if m in sys.modules))
+'''
+
+
+def bench_import(module: str, heavy: list, runs: int = RUNS):
+    """
+    import a module in a fresh interpreter several times
+    :param module: dotted module name to import
+    :param heavy: top level package names which should not be loaded by the import
+    :param runs: number of fresh interpreters to time
+    :return: best import time in seconds, list of heavy packages found in sys.modules
+    """
+
+    times = []
+    loaded = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=heavy)],
+                             capture_output=True, text=True, check=True).stdout.splitlines()
+        times.append(float(out[0]))
+        loaded = [m for m in out[1].split(',') if m] if len(out) > 1 else []
+
+    return min(times), loaded
+
+
+def main():
+    failed = False
+    for module, heavy in MODULES.items():
+        best, loaded = bench_import(module, heavy)
+        print(f'{module}: {best * 1000:.1f} ms (best of {RUNS})')
+
+        if loaded:
+            print(f'  FAIL heavy deps imported eagerly: {loaded}')
+            failed = True
+        if best > BUDGET_S:
+            print(f'  FAIL over import budget of {BUDGET_S * 1000:.0f} ms')
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
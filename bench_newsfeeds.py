@@ -0,0 +1,143 @@
+# dedup check and throughput benchmark for the news ingest pipeline, against the local fixture feeds
+# run with: python bench_newsfeeds.py
+# exits non-zero if fixture articles are not deduplicated as expected, or ingest is slower than the budget
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+from dn757657_fin_news_sources.newsfeeds import FeedSource, SeenIndex, newsfeeds_dicts
+
+FIXTURES = pathlib.Path(__file__).parent / 'fixtures' / 'news'
+FIXTURE_NEW = 7  # unique stories across the fixture feeds, after dropping syndicated and reworded copies
+
+SOURCES = 20  # synthetic feeds built from the fixture items for the throughput run
+ITEMS_PER_SOURCE = 2500
+OVERLAP = 0.25  # share of each synthetic feed syndicated from the feed before it
+MIN_ARTICLES_PER_MIN = 100000
+MAX_PARSE_PEAK_MB = 5.0
+
+
+def fixture_sources() -> list:
+    return [FeedSource(path.stem, str(path)) for path in sorted(FIXTURES.glob('*.xml'))]
+
+
+def check_dedup(workdir: pathlib.Path) -> list:
+    """
+    ingest the fixture feeds twice through a persistent seen index
+    :param workdir: Path type object pointing to a scratch directory
+    :return: list of failure messages, empty if all checks passed
+    """
+    failures = []
+    seen_path = workdir / 'seen.sqlite'
+
+    seen_index = SeenIndex(seen_path)
+    articles = [article for chunk in newsfeeds_dicts(fixture_sources(), seen_index=seen_index) for article in chunk]
+    seen_index.close()
+
+    if len(articles) != FIXTURE_NEW:
+        failures.append(f'first run yielded {len(articles)} articles, expected {FIXTURE_NEW}')
+    if len({article['article_id'] for article in articles}) != len(articles):
+        failures.append('first run yielded duplicate article ids')
+    if any(article['published'] is None or not article['link'] for article in articles):
+        failures.append('fixture article missing published time or link')
+
+    seen_index = SeenIndex(seen_path)  # a fresh process would reopen the same index
+    rerun = [article for chunk in newsfeeds_dicts(fixture_sources(), seen_index=seen_index) for article in chunk]
+    seen_index.close()
+
+    if rerun:
+        failures.append(f'rerun yielded {len(rerun)} articles already seen')
+
+    return failures
+
+
+def write_synthetic_feeds(workdir: pathlib.Path) -> list:
+    """
+    build large rss feeds by repeating the fixture items with new titles, each feed shares OVERLAP of its stories
+    with the feed before it so the run exercises cross source dedup
+    :param workdir: Path type object pointing to a scratch directory
+    :return: list of FeedSource
+    """
+    template = ET.parse(FIXTURES / 'markets_rss.xml').getroot().find('channel/item')
+    title = template.find('title').text
+    sources = []
+    n_shared = int(ITEMS_PER_SOURCE * OVERLAP)
+    for s in range(SOURCES):
+        path = workdir / f'synthetic_{s}.xml'
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>synthetic</title>')
+            for i in range(ITEMS_PER_SOURCE):
+                story = (s - 1) * ITEMS_PER_SOURCE + ITEMS_PER_SOURCE - n_shared + i if s and i < n_shared \
+                    else s * ITEMS_PER_SOURCE + i
+                template.find('title').text = f'Story {story}: {title}'
+                template.find('guid').text = f'synthetic-{s}-{i}'
+                file.write(ET.tostring(template, encoding='unicode'))
+            file.write('</channel></rss>')
+        sources.append(FeedSource(f'synthetic_{s}', str(path)))
+
+    return sources
+
+
+def bench_throughput(workdir: pathlib.Path) -> tuple:
+    """
+    :param workdir: Path type object pointing to a scratch directory
+    :return: articles parsed per minute, new articles yielded, expected new articles
+    """
+    sources = write_synthetic_feeds(workdir)
+    expected = SOURCES * ITEMS_PER_SOURCE - (SOURCES - 1) * int(ITEMS_PER_SOURCE * OVERLAP)
+
+    seen_index = SeenIndex(workdir / 'bench_seen.sqlite')
+    t = time.perf_counter()
+    n_new = sum(len(chunk) for chunk in newsfeeds_dicts(sources, seen_index=seen_index))
+    elapsed = time.perf_counter() - t
+    seen_index.close()
+
+    return SOURCES * ITEMS_PER_SOURCE / elapsed * 60, n_new, expected
+
+
+def bench_parse_memory(workdir: pathlib.Path) -> float:
+    """
+    :param workdir: Path type object pointing to a scratch directory holding the synthetic feeds
+    :return: peak MB traced while parsing one synthetic feed
+    """
+    tracemalloc.start()
+    for _ in FeedSource('synthetic_0', str(workdir / 'synthetic_0.xml')).articles():
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return peak / 1e6
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = pathlib.Path(tmp)
+
+        failures = check_dedup(workdir)
+        print(f'fixture dedup: {"FAIL" if failures else "ok"}')
+        for failure in failures:
+            print(f'  FAIL {failure}')
+
+        rate, n_new, expected = bench_throughput(workdir)
+        print(f'throughput: {rate:,.0f} articles/min over {SOURCES} feeds, {n_new} new of {expected} expected')
+        if n_new != expected:
+            failures.append('synthetic dedup')
+            print(f'  FAIL expected {expected} new articles')
+        if rate < MIN_ARTICLES_PER_MIN:
+            failures.append('throughput')
+            print(f'  FAIL under {MIN_ARTICLES_PER_MIN:,} articles/min')
+
+        peak = bench_parse_memory(workdir)
+        print(f'parse peak memory: {peak:.2f} MB for {ITEMS_PER_SOURCE} items')
+        if peak > MAX_PARSE_PEAK_MB:
+            failures.append('parse memory')
+            print(f'  FAIL over {MAX_PARSE_PEAK_MB} MB')
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,43 @@
 # functions for extracting data from bitfinex API
+from __future__ import annotations
+
 import datetime
-import bitfinex
-import requests
+import functools
 import logging
 import pytz
 import time
 import os
 
-import pandas as pd
 import datetime as dt
 
-from dotenv import load_dotenv
+from typing import TYPE_CHECKING
 
-env = load_dotenv()
-BITFIN_DB_NAME = os.getenv('BITFIN_DB_NAME')
+if TYPE_CHECKING:  # pandas is heavy, only import it when a function actually needs it
+    import pandas as pd
 
 logging.basicConfig(level=logging.INFO)  # log INFO statements to console
 
+
+@functools.lru_cache(maxsize=None)
+def _bitfin_db_name() -> str:
+    """
+    read BITFIN_DB_NAME from .env on first use rather than at import
+    :return: string database name
+    """
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    return os.getenv('BITFIN_DB_NAME')
+
+
+def __getattr__(name: str):
+    # keep bitfin.BITFIN_DB_NAME working without loading .env on import
+    if name == 'BITFIN_DB_NAME':
+        return _bitfin_db_name()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 BITFINEX_RESOLUTIONS = ["1m", "5m", "15m", "30m", "1h", "3h", "6h", "12h", "1D", "1W", "14D"]
 
 
@@ -30,6 +51,9 @@ def bitfin_get_listed_pairs() -> pd.DataFrame:
     :return: pandas dataframe of trading pairs structured ['bitfinex_pairs', 'symbol', 'currency']
     """
 
+    import pandas as pd
+    import requests
+
     url = "https://api-pub.bitfinex.com/v2/conf/pub:list:pair:exchange"
 
     headers = {"accept": "application/json"}
@@ -57,6 +81,8 @@ def bitfininterval_timedelta(interval: str) -> datetime.timedelta:
     :return: datetime.timedelta object
     """
 
+    import pandas as pd
+
     if interval in BITFINEX_RESOLUTIONS:
         interval = pd.Series([interval])
         interval = pd.to_timedelta(interval)
@@ -90,6 +116,8 @@ def bitfinbatch_pandf(pair_code: str,
     :return: pd.Dataframe containing market data for trading pair
     """
 
+    import pandas as pd
+
     interval_delta = bitfininterval_timedelta(interval)
 
     # need to localize so dates line up when requested from api
@@ -182,6 +210,9 @@ def bitfin_pandf(pair_code: str,
     else:
         end_unix_ms = None
 
+    import bitfinex
+    import pandas as pd
+
     api_v2 = bitfinex.bitfinex_v2.api_v2()
     cols = ['time', 'open', 'close', 'high', 'low', 'volume']
 
@@ -0,0 +1,323 @@
+# live candle streaming from the bitfinex websocket API
+from __future__ import annotations
+
+import asyncio
+import datetime
+import json
+import logging
+import threading
+
+from typing import Callable, TYPE_CHECKING
+
+from dn757657_crypto_num_sources.bitfin import bitfin_pandf, bitfininterval_timedelta
+
+if TYPE_CHECKING:
+    from pymongo import MongoClient
+
+
+BITFINEX_WS_URL = "wss://api-pub.bitfinex.com/ws/2"
+BITFINEX_WS_MAX_CHANNELS = 25  # bitfinex allows up to 30 subscriptions per connection, leave some headroom
+BITFINEX_WS_RECONNECT_CODE = 20051  # info event asking clients to reconnect
+CANDLE_COLS = ['time', 'open', 'close', 'high', 'low', 'volume']  # same order as websocket candles and bitfin_pandf
+
+
+def bitfin_candle_key(pair_code: str, interval: str = '1m') -> str:
+    """
+    websocket candle channel key for a trading pair e.g. btcusd -> trade:1m:tBTCUSD
+    :param pair_code: string trading pair code compatible with bitfinex
+    :param interval: string time interval compatible with bitfinex API
+    :return: string channel key
+    """
+    return f'trade:{interval}:t{pair_code.upper()}'
+
+
+def bitfincandle_dict(candle: list,
+                      pair_code: str,
+                      source: str = 'bitfinex') -> dict:
+    """
+    convert a raw [mts, open, close, high, low, volume] candle to a record named per bitfinex_renamecols, so it
+    matches records pushed from bitfinbatch_pandf
+    :param candle: raw bitfinex candle
+    :param pair_code: string trading pair code
+    :param source: string source prefix
+    :return: dict record with a naive utc datetime time
+    """
+    record = dict(zip(CANDLE_COLS, candle))
+    record['time'] = datetime.datetime.fromtimestamp(record['time'] / 1000, tz=datetime.timezone.utc).replace(tzinfo=None)
+
+    return {f'{source}_{pair_code}_{col}': value for col, value in record.items()}
+
+
+class BitfinCandleStream:
+    """
+    Subscribes to bitfinex candle channels for many pairs over a few websocket connections. The open (still
+    trading) candle of each pair is kept up to date in memory, and each candle is handed to on_closed once a newer
+    candle starts. Connections reconnect with backoff, and on resubscribe any candles missed while disconnected are
+    backfilled through the REST API before streaming resumes. Any error on a connection, including one raised while
+    backfilling, is logged and the connection reconnects, other connections are not affected.
+
+    on_closed is called on the event loop, so it should hand records off without blocking.
+
+    usage:
+        stream = BitfinCandleStream(['btcusd', 'ethusd'], on_closed=lambda pair, record: print(pair, record))
+        stream.run_forever()  # stream.stop() from another thread to end
+    """
+
+    def __init__(self,
+                 pairs: list,
+                 on_closed: Callable[[str, dict], None],
+                 interval: str = '1m',
+                 since: dict = None,
+                 url: str = BITFINEX_WS_URL,
+                 pairs_per_connection: int = BITFINEX_WS_MAX_CHANNELS,
+                 max_reconnect_delay: float = 60,
+                 source: str = 'bitfinex'):
+        """
+        :param pairs: list of string trading pair codes compatible with bitfinex
+        :param on_closed: called with (pair_code, record) for each closed candle, in time order per pair
+        :param interval: string time interval compatible with bitfinex API
+        :param since: dict of pair_code -> utc datetime of the newest candle already stored, later candles are
+            backfilled on the first connect. Pairs not included start from the first live snapshot
+        :param url: websocket endpoint, point at a local server for testing
+        :param pairs_per_connection: number of channels subscribed per websocket connection
+        :param max_reconnect_delay: upper limit on seconds between reconnect attempts
+        :param source: string source prefix for record names
+        """
+        self.pairs = list(pairs)
+        self.on_closed = on_closed
+        self.interval = interval
+        self.interval_ms = int(bitfininterval_timedelta(interval).total_seconds() * 1000)
+        self.url = url
+        self.pairs_per_connection = pairs_per_connection
+        self.max_reconnect_delay = max_reconnect_delay
+        self.source = source
+
+        from dn757657_data_endpoints.candleStore import datetime_unixms
+
+        self.open_candles = {}  # pair -> raw candle currently trading
+        self.last_closed = {pair: datetime_unixms(dt) for pair, dt in (since or {}).items() if dt is not None}
+
+        self._stopped = False
+        self._stop_event = None  # set by stop() to cut a reconnect backoff short
+        self._loop = None
+        self._connections = set()
+
+    def open_candle(self, pair_code: str) -> dict:
+        """
+        :param pair_code: string trading pair code
+        :return: record of the candle currently trading, None if none has been received
+        """
+        candle = self.open_candles.get(pair_code)
+        return None if candle is None else bitfincandle_dict(candle, pair_code, self.source)
+
+    def run_forever(self):
+        """
+        stream until stop() is called
+        :return:
+        """
+        asyncio.run(self.run())
+
+    def stop(self):
+        """
+        stop streaming, safe to call from another thread
+        :return:
+        """
+        self._stopped = True
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+            for ws in list(self._connections):
+                asyncio.run_coroutine_threadsafe(ws.close(), self._loop)
+
+    async def run(self):
+        """
+        stream on the running event loop until stop() is called
+        :return:
+        """
+        self._stop_event = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        chunks = [self.pairs[i:i + self.pairs_per_connection]
+                  for i in range(0, len(self.pairs), self.pairs_per_connection)]
+
+        await asyncio.gather(*(self._connection(chunk) for chunk in chunks))
+
+    async def _connection(self, pairs: list):
+        import websockets
+
+        delay = 1
+        while not self._stopped:
+            try:
+                async with websockets.connect(self.url, ping_interval=20) as ws:
+                    self._connections.add(ws)
+                    try:
+                        await self._stream(ws, pairs)
+                        delay = 1
+                    finally:
+                        self._connections.discard(ws)
+
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+                logging.info(f'Bitfinex websocket error for {pairs}: {e!r}')
+
+            except Exception as e:  # e.g. a malformed message or a failed backfill, resubscribing resyncs the pairs
+                logging.info(f'Bitfinex stream failed for {pairs}: {e!r}')
+
+            if self._stopped:
+                break
+
+            logging.info(f'Reconnecting bitfinex websocket for {pairs} in {delay}s')
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def _stream(self, ws, pairs: list):
+        keys = {bitfin_candle_key(pair, self.interval): pair for pair in pairs}
+        for key in keys:
+            await ws.send(json.dumps({'event': 'subscribe', 'channel': 'candles', 'key': key}))
+
+        channels = {}  # chanId -> pair
+        async for message in ws:
+            msg = json.loads(message)
+
+            if isinstance(msg, dict):
+                event = msg.get('event')
+                if event == 'subscribed':
+                    channels[msg['chanId']] = keys[msg['key']]
+                    logging.info(f"Subscribed to bitfinex candles {msg['key']}")
+                elif event == 'error':
+                    logging.info(f'Bitfinex websocket error event: {msg}')
+                elif event == 'info' and msg.get('code') == BITFINEX_WS_RECONNECT_CODE:
+                    logging.info('Bitfinex requested reconnect')
+                    return
+                continue
+
+            chan_id, payload = msg[0], msg[1]
+            pair = channels.get(chan_id)
+            if pair is None or payload == 'hb' or not payload:
+                continue
+
+            if isinstance(payload[0], list):
+                await self._on_snapshot(pair, payload)
+            else:
+                self._on_candle(pair, payload)
+
+    async def _on_snapshot(self, pair: str, candles: list):
+        candles = sorted(candles, key=lambda candle: candle[0])
+        closed, self.open_candles[pair] = candles[:-1], candles[-1]
+
+        last = self.last_closed.get(pair)
+        if last is None:
+            # nothing stored to catch up from, start live from here
+            if closed:
+                self.last_closed[pair] = closed[-1][0]
+            return
+
+        first = closed[0][0] if closed else candles[-1][0]
+        if first > last + self.interval_ms:
+            missed = await asyncio.get_running_loop().run_in_executor(
+                None, self._rest_backfill, pair, last + self.interval_ms, first - 1)
+            for candle in missed:
+                self._close(pair, candle)
+
+        for candle in closed:
+            self._close(pair, candle)
+
+    def _on_candle(self, pair: str, candle: list):
+        current = self.open_candles.get(pair)
+        if current is not None and candle[0] < current[0]:
+            return  # late update of a candle already closed
+        if current is not None and candle[0] > current[0]:
+            self._close(pair, current)
+        self.open_candles[pair] = candle
+
+    def _close(self, pair: str, candle: list):
+        last = self.last_closed.get(pair)
+        if last is not None and candle[0] <= last:
+            return
+        self.last_closed[pair] = candle[0]
+        self.on_closed(pair, bitfincandle_dict(candle, pair, self.source))
+
+    def _rest_backfill(self, pair: str, start_ms: int, end_ms: int) -> list:
+        """
+        fetch candles between start_ms and end_ms inclusive through the REST API, paging backwards from end as
+        bitfin_pandf returns the newest candles when a request exceeds its limit
+        :return: list of raw candles ascending by time
+        """
+        candles = {}
+        end = end_ms
+        while end >= start_ms:
+            df = bitfin_pandf(pair_code=pair,
+                              interval=self.interval,
+                              start=datetime.datetime.fromtimestamp(start_ms / 1000, tz=datetime.timezone.utc),
+                              end=datetime.datetime.fromtimestamp(end / 1000, tz=datetime.timezone.utc))
+            if isinstance(df, int):  # rate limited, bitfin_pandf has already waited
+                continue
+            if df.empty:
+                break
+
+            times = df['time'].values.astype('datetime64[ms]').astype('int64')
+            for mts, row in zip(times, df[CANDLE_COLS[1:]].itertuples(index=False)):
+                if start_ms <= mts <= end_ms:
+                    candles[int(mts)] = [int(mts), *row]
+
+            oldest = int(times.min())
+            if oldest <= start_ms:
+                break
+            end = oldest - 1
+
+        logging.info(f'Backfilled {len(candles)} {pair} candles from bitfinex REST API')
+
+        return [candles[mts] for mts in sorted(candles)]
+
+
+def bitfinstream_mongodb(pairs: list,
+                         mongodb_client: MongoClient,
+                         db_name: str,
+                         interval: str = '1m',
+                         resume: bool = True,
+                         url: str = BITFINEX_WS_URL,
+                         max_age: float = 0.25) -> BitfinCandleStream:
+    """
+    Stream closed candles for many pairs into mongo, one collection per pair named by pair code as with
+    bitfinbatch_pandf -> pandf_mongodb. Candles are micro batched through a MongoBufferedWriter per pair, which
+    never blocks the stream, candles are dropped and counted by the writer if mongo falls far enough behind.
+    Streams on a background thread, call .stop() on the returned stream to end it and flush the writers.
+
+    :param pairs: list of string trading pair codes compatible with bitfinex
+    :param mongodb_client: mongo client to connect to
+    :param db_name: string name of the database to push data into
+    :param interval: string time interval compatible with bitfinex API
+    :param resume: backfill from the newest candle already in each collection, see mongodb_latestdatetime
+    :param url: websocket endpoint
+    :param max_age: seconds a closed candle may wait before its batch is written
+    :return: the running BitfinCandleStream
+    """
+    from dn757657_data_endpoints.mongoDB import mongodb_latestdatetime
+    from dn757657_data_endpoints.mongoWriter import MongoBufferedWriter
+
+    writers = {pair: MongoBufferedWriter(mongodb_client, db_name, pair, max_batch=500, max_age=max_age, block=False)
+               for pair in pairs}
+
+    since = None
+    if resume:
+        since = {pair: mongodb_latestdatetime(mongodb_client=mongodb_client,
+                                              db_name=db_name,
+                                              collection_name=pair,
+                                              time_col=f'bitfinex_{pair}_time') for pair in pairs}
+
+    stream = BitfinCandleStream(pairs=pairs,
+                                on_closed=lambda pair, record: writers[pair].write(record),
+                                interval=interval,
+                                since=since,
+                                url=url)
+
+    def run():
+        try:
+            stream.run_forever()
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+    threading.Thread(target=run, name='bitfinex-candle-stream', daemon=True).start()
+
+    return stream
@@ -0,0 +1,309 @@
+# local append-only memory mapped candle store, for fast repeated reads of candle history by models
+from __future__ import annotations
+
+import datetime
+import logging
+import os
+import pathlib
+
+import numpy as np
+
+from typing import TYPE_CHECKING
+from pymongo import MongoClient, ASCENDING
+
+if TYPE_CHECKING:  # pandas is heavy, only import it when a function actually needs it
+    import pandas as pd
+
+
+CANDLE_COLS = ['time', 'open', 'close', 'high', 'low', 'volume']  # same order as bitfin_pandf
+COL_DTYPES = {'time': np.int64, 'open': np.float64, 'close': np.float64,
+              'high': np.float64, 'low': np.float64, 'volume': np.float64}
+INDEX_STRIDE = 4096  # rows between sparse index entries
+
+
+def datetime_unixms(value) -> int:
+    """
+    convert a time bound to unix milliseconds, naive datetimes are taken as utc like the rest of the pipelines
+    :param value: datetime.datetime, pd.Timestamp, np.datetime64 or int unix ms
+    :return: int unix milliseconds, None if value is None
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, np.datetime64):
+        return int(value.astype('datetime64[ms]').astype(np.int64))
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return int(value.timestamp() * 1000)
+
+    raise TypeError(f"Cannot convert {type(value).__name__} to unix ms")
+
+
+class CandleStore:
+    """
+    Append only columnar candle store for a single (pair, interval), laid out as
+        <root>/<source>/<pair_code>/<interval>/<col>.bin
+    with one fixed width file per column, int64 unix ms times and float64 ohlcv, plus index.bin holding the time of
+    every INDEX_STRIDE-th row. Reads are np.memmap views sliced by binary search on time, so they copy nothing and
+    several model processes reading the same store share pages through the OS cache.
+
+    Only one process should append to a store at a time. Rows are only ever appended in increasing time order,
+    rows at or before the latest stored time are dropped.
+    """
+
+    def __init__(self,
+                 root: pathlib.Path,
+                 pair_code: str,
+                 interval: str = '1m',
+                 source: str = 'bitfinex'):
+        """
+        :param root: Path type object pointing to the store root directory, created if missing
+        :param pair_code: string trading pair code e.g. btcusd
+        :param interval: string bitfinex time interval of the candles
+        :param source: string source of the candles
+        """
+        self.pair_code = pair_code
+        self.interval = interval
+        self.source = source
+        self.path = pathlib.Path(root) / source / pair_code / interval
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self._maps = {}  # col -> memmap, reopened when the store grows
+        self._maps_len = -1
+
+    def _col_path(self, col: str) -> pathlib.Path:
+        return self.path / f'{col}.bin'
+
+    def __len__(self) -> int:
+        # time column is written last on append so its length is the committed row count
+        time_path = self._col_path('time')
+        if not time_path.exists():
+            return 0
+        return time_path.stat().st_size // np.dtype(np.int64).itemsize
+
+    def _memmaps(self) -> dict:
+        n_rows = len(self)
+        if n_rows != self._maps_len:
+            self._maps = {}
+            if n_rows:
+                for col in CANDLE_COLS:
+                    self._maps[col] = np.memmap(self._col_path(col), dtype=COL_DTYPES[col], mode='r', shape=(n_rows,))
+                self._maps['index'] = np.memmap(self._col_path('index'), dtype=np.int64, mode='r',
+                                                shape=((n_rows - 1) // INDEX_STRIDE + 1,))
+            self._maps_len = n_rows
+
+        return self._maps
+
+    def latest_time(self) -> int:
+        """
+        :return: int unix ms time of the newest stored candle, None if the store is empty
+        """
+        maps = self._memmaps()
+        if not maps:
+            return None
+        return int(maps['time'][-1])
+
+    def append(self,
+               time: np.ndarray,
+               open: np.ndarray,
+               close: np.ndarray,
+               high: np.ndarray,
+               low: np.ndarray,
+               volume: np.ndarray) -> int:
+        """
+        append candles sorted ascending by time, candles at or before latest_time are dropped
+
+        :param time: int64 unix ms candle open times
+        :param open: float64 open prices
+        :param close: float64 close prices
+        :param high: float64 high prices
+        :param low: float64 low prices
+        :param volume: float64 volumes
+        :return: number of candles appended
+        """
+        cols = {'time': time, 'open': open, 'close': close, 'high': high, 'low': low, 'volume': volume}
+        cols = {col: np.ascontiguousarray(values, dtype=COL_DTYPES[col]) for col, values in cols.items()}
+
+        if np.any(np.diff(cols['time']) <= 0):
+            raise ValueError("Candle times must be strictly increasing")
+
+        n_rows = len(self)
+        latest = self.latest_time()
+        if latest is not None:
+            keep = cols['time'] > latest
+            cols = {col: values[keep] for col, values in cols.items()}
+
+        n_new = len(cols['time'])
+        if n_new == 0:
+            return 0
+
+        # data columns first, truncating anything left over from an interrupted append, then the index, then time
+        # which commits the rows
+        for col in CANDLE_COLS[1:]:
+            with open_for_append(self._col_path(col), n_rows * 8) as f:
+                f.write(cols[col].tobytes())
+
+        positions = np.arange(n_rows, n_rows + n_new)
+        index_times = cols['time'][positions % INDEX_STRIDE == 0]
+        n_index = (n_rows - 1) // INDEX_STRIDE + 1 if n_rows else 0
+        with open_for_append(self._col_path('index'), n_index * 8) as f:
+            f.write(index_times.tobytes())
+
+        with open_for_append(self._col_path('time'), n_rows * 8) as f:
+            f.write(cols['time'].tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        logging.info(f"Appended {n_new} candles to {self.path}")
+
+        return n_new
+
+    def bounds(self, start=None, end=None) -> tuple:
+        """
+        row positions of the [start, end) time window, narrowed by the sparse index then binary searched
+        :param start: inclusive lower time bound, see datetime_unixms, None for the first row
+        :param end: exclusive upper time bound, see datetime_unixms, None for past the last row
+        :return: (lo, hi) row positions
+        """
+        maps = self._memmaps()
+        if not maps:
+            return 0, 0
+
+        times, index = maps['time'], maps['index']
+
+        def position(bound):
+            block = max(int(np.searchsorted(index, bound, side='left')) - 1, 0)
+            lo = block * INDEX_STRIDE
+            hi = min(lo + 2 * INDEX_STRIDE, len(times))
+            return lo + int(np.searchsorted(times[lo:hi], bound, side='left'))
+
+        lo = 0 if start is None else position(datetime_unixms(start))
+        hi = len(times) if end is None else position(datetime_unixms(end))
+
+        return lo, max(lo, hi)
+
+    def read(self, start=None, end=None) -> dict:
+        """
+        read the [start, end) time window without copying
+        :param start: inclusive lower time bound, see datetime_unixms, None for the first candle
+        :param end: exclusive upper time bound, see datetime_unixms, None for the last candle
+        :return: dict of column name -> read only np.memmap view, times are int64 unix ms
+        """
+        maps = self._memmaps()
+        if not maps:
+            return {col: np.empty(0, dtype=COL_DTYPES[col]) for col in CANDLE_COLS}
+
+        lo, hi = self.bounds(start=start, end=end)
+
+        return {col: maps[col][lo:hi] for col in CANDLE_COLS}
+
+
+def open_for_append(path: pathlib.Path, size: int):
+    """
+    open a store column for appending, truncating it to size bytes so a column left longer than the committed
+    rows by an interrupted append is repaired
+    :param path: Path type object pointing to the column file
+    :param size: committed size of the column in bytes
+    :return: binary file object positioned at size
+    """
+    f = open(path, 'ab')
+    if f.tell() != size:
+        f.truncate(size)
+        f.seek(size)
+
+    return f
+
+
+def pandf_candlestore(data: pd.DataFrame,
+                      store: CandleStore) -> int:
+    """
+    Push a candle dataframe e.g. from bitfinbatch_pandf to a local candle store, columns are expected to be named
+    per bitfinex_renamecols i.e. <source>_<pair_code>_<col>
+    :param data: pandas dataframe of candles, empty dataframes will be ignored
+    :param store: candle store to append to
+    :return: number of candles appended
+    """
+
+    if data.empty:
+        return 0
+
+    prefix = f'{store.source}_{store.pair_code}_'
+    time_col = prefix + 'time'
+
+    data = data.sort_values(time_col).drop_duplicates(subset=time_col, keep='last')
+
+    times = data[time_col].values.astype('datetime64[ms]').astype(np.int64)
+    values = {col: data[prefix + col].to_numpy(dtype=np.float64) for col in CANDLE_COLS[1:]}
+
+    return store.append(time=times, **values)
+
+
+def mongodb_candlestore(mongodb_client: MongoClient,
+                        db_name: str,
+                        collection_name: str,
+                        store: CandleStore,
+                        batch_size: int = 100000) -> int:
+    """
+    Fill a local candle store from a mongo candle collection, only candles newer than the latest stored candle
+    are fetched so this can be rerun to keep the store up to date
+    :param mongodb_client: mongo client to connect to
+    :param db_name: string database name
+    :param collection_name: string collection name e.g. btcusd
+    :param store: candle store to append to
+    :param batch_size: number of documents per cursor batch
+    :return: number of candles appended
+    """
+    from dn757657_data_endpoints.mongoArrow import candle_arrow_schema, mongodb_arrowbatches
+    from dn757657_data_endpoints.mongoQuery import mongodb_rangefilter
+
+    schema = candle_arrow_schema(pair_code=store.pair_code, source=store.source)
+    time_col = schema.names[0]
+
+    latest = store.latest_time()
+    if latest is not None:
+        latest = datetime.datetime.fromtimestamp(latest / 1000, tz=datetime.timezone.utc)
+    query = mongodb_rangefilter(time_col, lower_bound=latest, lower_op='$gt')
+
+    n_appended = 0
+    for batch in mongodb_arrowbatches(
+            db_name=db_name,
+            mongodb_client=mongodb_client,
+            collection_name=collection_name,
+            schema=schema,
+            query=query,
+            sort_by=time_col,
+            sort_dir=ASCENDING,
+            batch_size=batch_size):
+        cols = [batch.column(i).to_numpy(zero_copy_only=False) for i in range(batch.num_columns)]
+        # collection may hold duplicate candles, keep the first of each time
+        times = cols[0].astype('datetime64[ms]').astype(np.int64)
+        times, first = np.unique(times, return_index=True)
+        n_appended += store.append(times, *(col[first] for col in cols[1:]))
+
+    logging.info(f"Loaded {n_appended} Records from MongoDB:{db_name}:{collection_name} to {store.path}")
+
+    return n_appended
+
+
+def candlestore_pandf(store: CandleStore,
+                      start=None,
+                      end=None) -> pd.DataFrame:
+    """
+    Fetch a [start, end) window from a local candle store as a dataframe shaped like bitfinbatch_pandf output,
+    use CandleStore.read for copy free numpy views
+    :param store: candle store to read from
+    :param start: inclusive lower time bound, see datetime_unixms
+    :param end: exclusive upper time bound, see datetime_unixms
+    :return: pandas dataframe with <source>_<pair_code>_<col> columns
+    """
+    import pandas as pd
+
+    cols = store.read(start=start, end=end)
+    prefix = f'{store.source}_{store.pair_code}_'
+
+    df = pd.DataFrame({prefix + col: np.asarray(values) for col, values in cols.items()})
+    df[prefix + 'time'] = pd.to_datetime(df[prefix + 'time'], unit='ms')
+
+    return df
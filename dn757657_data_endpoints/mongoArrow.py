@@ -0,0 +1,246 @@
+# functions for reading MongoDB collections as Apache Arrow data
+from __future__ import annotations
+
+import logging
+import pathlib
+
+from typing import Iterator, TYPE_CHECKING
+from pymongo import MongoClient, DESCENDING
+
+if TYPE_CHECKING:  # pyarrow and pandas are heavy, only import them when a function actually needs them
+    import pandas as pd
+    import pyarrow as pa
+
+
+CANDLE_FIELDS = ['open', 'close', 'high', 'low', 'volume']
+
+
+def candle_arrow_schema(pair_code: str,
+                        source: str = 'bitfinex',
+                        time_unit: str = 'ms') -> pa.Schema:
+    """
+    arrow schema for a candle collection as written by pandf_mongodb from bitfinbatch_pandf, column names are
+    prefixed per bitfinex_renamecols e.g. bitfinex_btcusd_time
+
+    :param pair_code: string trading pair code e.g. btcusd
+    :param source: string source prefix used when the columns were renamed
+    :param time_unit: arrow timestamp unit for the time column, mongo stores datetimes at ms resolution
+    :return: pyarrow schema with a timestamp time column and float64 ohlcv columns
+    """
+    import pyarrow as pa
+
+    prefix = f'{source}_{pair_code}_'
+    fields = [pa.field(prefix + 'time', pa.timestamp(time_unit))]
+    fields += [pa.field(prefix + name, pa.float64()) for name in CANDLE_FIELDS]
+
+    return pa.schema(fields)
+
+
+def _bson_schema(schema: pa.Schema):
+    # pymongoarrow schemas are built from a field name -> arrow type mapping
+    from pymongoarrow.api import Schema
+
+    return Schema({field.name: field.type for field in schema})
+
+
+def _raw_batch_table(raw_batch: bytes,
+                     bson_schema,
+                     codec_options) -> pa.Table:
+    # decode one raw BSON batch straight into arrow columns, the context api changed in pymongoarrow 1.3
+    from pymongoarrow.api import PyMongoArrowContext
+
+    if hasattr(PyMongoArrowContext, 'from_schema'):
+        from pymongoarrow.lib import process_bson_stream
+
+        context = PyMongoArrowContext.from_schema(bson_schema, codec_options=codec_options)
+        process_bson_stream(raw_batch, context)
+    else:
+        context = PyMongoArrowContext(bson_schema, codec_options=codec_options)
+        context.process_bson_stream(raw_batch)
+
+    return context.finish()
+
+
+def mongodb_arrowbatches(db_name: str,
+                         mongodb_client: MongoClient,
+                         collection_name: str,
+                         schema: pa.Schema,
+                         query: dict = None,
+                         sort_by: str = None,
+                         sort_dir: int = DESCENDING,
+                         limit: int = -1,
+                         batch_size: int = 10000) -> Iterator[pa.RecordBatch]:
+    """
+    Stream a collection as arrow record batches. Documents are fetched as raw BSON batches and only the fields in
+    the schema are projected, then each batch is decoded by pymongoarrow's native decoder straight into typed
+    arrow columns, no python objects are created per document or value.
+
+    :param db_name: name of database requested
+    :param mongodb_client: mongo client to connect to
+    :param collection_name: name of collection requested
+    :param schema: pyarrow schema declaring the fields and types to read, missing values are read as null
+    :param query: mongo filter document
+    :param sort_by: field to sort returned data by, unsorted if None
+    :param sort_dir: [1: asc, -1: desc] direction to sort data given sort_by
+    :param limit: limit the number of returned entries, -1 for no limit
+    :param batch_size: number of documents per cursor batch, and so per record batch
+    :return: generator of pyarrow record batches matching schema
+    """
+    collection = mongodb_client[db_name][collection_name]
+    bson_schema = _bson_schema(schema)
+
+    projection = {name: 1 for name in schema.names}
+    projection['_id'] = 1 if '_id' in projection else 0  # only decoded if asked for
+
+    cursor = collection.find_raw_batches(
+        query,
+        projection=projection,
+        sort=[(sort_by, sort_dir)] if sort_by else None,
+        limit=0 if limit == -1 else limit,
+        batch_size=batch_size
+    )
+
+    codec_options = collection.codec_options
+    for raw_batch in cursor:
+        table = _raw_batch_table(raw_batch, bson_schema, codec_options)
+        if table.num_rows:
+            yield from table.cast(schema).to_batches()
+
+
+def mongodb_arrowtable(db_name: str,
+                       mongodb_client: MongoClient,
+                       collection_name: str,
+                       schema: pa.Schema,
+                       query: dict = None,
+                       sort_by: str = None,
+                       sort_dir: int = DESCENDING,
+                       limit: int = -1,
+                       batch_size: int = 10000) -> pa.Table:
+    """
+    Fetch data from Mongo Database as an arrow table, every cursor batch is decoded natively into one set of
+    growing arrow columns, see mongodb_arrowbatches
+
+    :param db_name: name of database requested
+    :param mongodb_client: mongo client to connect to
+    :param collection_name: name of collection requested
+    :param schema: pyarrow schema declaring the fields and types to read
+    :param query: mongo filter document
+    :param sort_by: field to sort returned data by, unsorted if None
+    :param sort_dir: [1: asc, -1: desc] direction to sort data given sort_by
+    :param limit: limit the number of returned entries, -1 for no limit
+    :param batch_size: number of documents per cursor batch
+    :return: pyarrow table matching schema
+    """
+    from pymongoarrow.api import find_arrow_all
+
+    projection = {name: 1 for name in schema.names}
+    projection['_id'] = 1 if '_id' in projection else 0
+
+    table = find_arrow_all(
+        mongodb_client[db_name][collection_name],
+        query or {},
+        schema=_bson_schema(schema),
+        projection=projection,
+        sort=[(sort_by, sort_dir)] if sort_by else None,
+        limit=0 if limit == -1 else limit,
+        batch_size=batch_size
+    ).cast(schema)
+
+    logging.info(f"Loaded {table.num_rows} Records from MongoDB:{db_name}:{collection_name} as Arrow Table")
+
+    return table
+
+
+def mongodb_arrow_pandf(db_name: str,
+                        mongodb_client: MongoClient,
+                        collection_name: str,
+                        schema: pa.Schema,
+                        query: dict = None,
+                        sort_by: str = None,
+                        sort_dir: int = DESCENDING,
+                        limit: int = -1,
+                        batch_size: int = 10000) -> pd.DataFrame:
+    """
+    Fetch data from Mongo Database as a pandas dataframe through arrow, alternative to mongodb_pandf for
+    collections with a known flat schema e.g. candles. Numeric columns without nulls are handed to pandas
+    without copying, and arrow buffers are released as they are converted.
+
+    :param db_name: name of database requested
+    :param mongodb_client: mongo client to connect to
+    :param collection_name: name of collection requested
+    :param schema: pyarrow schema declaring the fields and types to read
+    :param query: mongo filter document
+    :param sort_by: field to sort returned data by, unsorted if None
+    :param sort_dir: [1: asc, -1: desc] direction to sort data given sort_by
+    :param limit: limit the number of returned entries, -1 for no limit
+    :param batch_size: number of documents per cursor batch
+    :return: data as pandas df from mongodb, without the mongo _id column
+    """
+
+    table = mongodb_arrowtable(
+        db_name=db_name,
+        mongodb_client=mongodb_client,
+        collection_name=collection_name,
+        schema=schema,
+        query=query,
+        sort_by=sort_by,
+        sort_dir=sort_dir,
+        limit=limit,
+        batch_size=batch_size
+    )
+
+    # one block per column so pandas can take arrow's buffers without consolidating, arrow frees as it goes
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+
+    return df
+
+
+def mongodb_arrow_parquet(db_name: str,
+                          path: pathlib.Path,
+                          mongodb_client: MongoClient,
+                          collection_name: str,
+                          schema: pa.Schema,
+                          query: dict = None,
+                          sort_by: str = None,
+                          sort_dir: int = DESCENDING,
+                          limit: int = -1,
+                          batch_size: int = 10000,
+                          compression: str = 'snappy') -> int:
+    """
+    Write data from Mongo Database straight to parquet in FS, record batches are written as they are decoded so
+    the collection never has to fit in memory
+
+    :param db_name: name of database requested
+    :param path: Path type object pointing to file destination
+    :param mongodb_client: mongo client to connect to
+    :param collection_name: name of collection requested
+    :param schema: pyarrow schema declaring the fields and types to read
+    :param query: mongo filter document
+    :param sort_by: field to sort returned data by, unsorted if None
+    :param sort_dir: [1: asc, -1: desc] direction to sort data given sort_by
+    :param limit: limit the number of returned entries, -1 for no limit
+    :param batch_size: number of documents per cursor batch
+    :param compression: parquet compression codec
+    :return: number of records written
+    """
+    import pyarrow.parquet as pq
+
+    n_records = 0
+    with pq.ParquetWriter(path, schema, compression=compression) as writer:
+        for batch in mongodb_arrowbatches(
+                db_name=db_name,
+                mongodb_client=mongodb_client,
+                collection_name=collection_name,
+                schema=schema,
+                query=query,
+                sort_by=sort_by,
+                sort_dir=sort_dir,
+                limit=limit,
+                batch_size=batch_size):
+            writer.write_batch(batch)
+            n_records += batch.num_rows
+
+    logging.info(f"Loaded MongoDB:{db_name}:{collection_name}:{n_records} Records as Parquet to: {path.__repr__()}")
+
+    return n_records
@@ -0,0 +1,300 @@
+# aligned multi pair panels of candle data, for building cross asset model inputs
+from __future__ import annotations
+
+import collections
+import datetime
+import hashlib
+import logging
+import pathlib
+import threading
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+from pymongo import MongoClient, ASCENDING, DESCENDING
+
+from dn757657_data_endpoints.mongoRetention import ROLLUP_AGGS
+
+if TYPE_CHECKING:  # pandas is heavy, only import it when a function actually needs it
+    import pandas as pd
+
+
+_PANEL_CACHE = collections.OrderedDict()  # request key -> Panel, least recently used first
+_PANEL_CACHE_LOCK = threading.Lock()
+PANEL_CACHE_SIZE = 16
+
+
+class Panel:
+    """
+    Candle data for many pairs aligned on a shared time grid
+        values: float array shaped (time, pair, field), NaN where a pair has no data
+        times: datetime64[ms] grid times, the start of each interval
+        pairs: list of pair codes along axis 1
+        fields: list of candle fields along axis 2 e.g. ['close', 'volume']
+    """
+
+    def __init__(self, values: np.ndarray, times: np.ndarray, pairs: list, fields: list):
+        self.values = values
+        self.times = times
+        self.pairs = list(pairs)
+        self.fields = list(fields)
+
+    def to_pandf(self) -> pd.DataFrame:
+        """
+        :return: wide pandas dataframe indexed by time with (pair, field) columns, sharing memory with values
+        """
+        import pandas as pd
+
+        columns = pd.MultiIndex.from_product([self.pairs, self.fields], names=['pair', 'field'])
+        wide = self.values.reshape(len(self.times), len(self.pairs) * len(self.fields))
+
+        return pd.DataFrame(wide, index=pd.DatetimeIndex(self.times, name='time'), columns=columns, copy=False)
+
+
+def ffill_array(values: np.ndarray, limit: int = None) -> np.ndarray:
+    """
+    forward fill NaNs down axis 0 of a 2-D array
+    :param values: 2-D float array
+    :param limit: maximum number of steps a value is carried forward, unlimited if None
+    :return: filled copy of values
+    """
+    steps = np.arange(values.shape[0])[:, None]
+    last = np.where(~np.isnan(values), steps, -1)
+    np.maximum.accumulate(last, axis=0, out=last)
+
+    filled = values[np.maximum(last, 0), np.arange(values.shape[1])]
+    filled[last < 0] = np.nan
+    if limit is not None:
+        filled[steps - last > limit] = np.nan
+
+    return filled
+
+
+def bucket_candles(steps: np.ndarray,
+                   values: np.ndarray,
+                   fields: list) -> tuple:
+    """
+    reduce candles sharing a grid step to one candle per step, each field aggregated as in a candle rollup
+    (open first, close last, high max, low min, volume sum, anything else last)
+    :param steps: int array of grid steps, ascending
+    :param values: (rows, fields) float array of candles matching steps
+    :param fields: candle fields along axis 1 of values
+    :return: int array of unique steps, (steps, fields) float array of aggregated candles
+    """
+    if not len(steps):
+        return steps, values
+
+    starts = np.flatnonzero(np.r_[True, steps[1:] != steps[:-1]])
+    ends = np.r_[starts[1:], len(steps)] - 1
+    reducers = {'max': np.fmax, 'min': np.fmin, 'sum': np.add}
+
+    bucketed = np.empty((len(starts), len(fields)), dtype=values.dtype)
+    for j, field in enumerate(fields):
+        agg = ROLLUP_AGGS.get('_' + field, 'last')
+        column = values[:, j]
+        if agg == 'first':
+            bucketed[:, j] = column[starts]
+        elif agg in reducers:
+            bucketed[:, j] = reducers[agg].reduceat(column, starts)
+        else:
+            bucketed[:, j] = column[ends]
+
+    return steps[starts], bucketed
+
+
+def _read_pair(mongodb_client: MongoClient,
+               db_name: str,
+               pair_code: str,
+               source: str,
+               fields: list,
+               lower_bound: datetime.datetime,
+               upper_bound: datetime.datetime,
+               find_newest: bool) -> tuple:
+    # runs on a worker thread, returns int64 unix ms times, a (rows, fields) float array and the unix ms time of the
+    # newest candle stored for the pair, None if there are none or find_newest is off
+    import pyarrow as pa
+
+    from dn757657_data_endpoints.candleStore import datetime_unixms
+    from dn757657_data_endpoints.mongoArrow import mongodb_arrowtable
+    from dn757657_data_endpoints.mongoQuery import mongodb_rangecursor, mongodb_rangefilter
+
+    prefix = f'{source}_{pair_code}_'
+    schema = pa.schema([pa.field(prefix + 'time', pa.timestamp('ms'))] +
+                       [pa.field(prefix + field, pa.float64()) for field in fields])
+
+    table = mongodb_arrowtable(
+        db_name=db_name,
+        mongodb_client=mongodb_client,
+        collection_name=pair_code,
+        schema=schema,
+        query=mongodb_rangefilter(prefix + 'time', lower_bound=lower_bound, upper_bound=upper_bound),
+        sort_by=prefix + 'time',
+        sort_dir=ASCENDING
+    )
+
+    times = table.column(0).to_numpy().astype(np.int64)
+    values = np.column_stack([table.column(i + 1).to_numpy(zero_copy_only=False) for i in range(len(fields))]) \
+        if table.num_rows else np.empty((0, len(fields)))
+
+    newest = None
+    if find_newest:  # only needed to decide if the window is complete enough to cache
+        newest = next(mongodb_rangecursor(mongodb_client[db_name][pair_code], prefix + 'time', sort_dir=DESCENDING,
+                                          limit=1, projection={prefix + 'time': 1}, ensure_index=False,
+                                          check_types=False), None)
+
+    return times, values, None if newest is None else datetime_unixms(newest[prefix + 'time'])
+
+
+def _panel_key(mongodb_client: MongoClient, *args) -> str:
+    # the servers are part of the key, so the same database on different endpoints e.g. local and tailscale differ
+    servers = sorted(mongodb_client.topology_description.server_descriptions())
+    return hashlib.sha1(repr((servers,) + args).encode()).hexdigest()
+
+
+def mongodb_panel(pairs: list,
+                  mongodb_client: MongoClient,
+                  db_name: str,
+                  lower_bound: datetime.datetime,
+                  upper_bound: datetime.datetime,
+                  fields: list = ('close',),
+                  freq: str = '1m',
+                  ffill: bool = True,
+                  max_staleness: datetime.timedelta = None,
+                  source: str = 'bitfinex',
+                  dtype=np.float64,
+                  max_workers: int = 8,
+                  cache: bool = False,
+                  cache_dir: pathlib.Path = None) -> Panel:
+    """
+    Build a time x pair x field panel of candle data for many pairs over a [lower_bound, upper_bound) window.
+    Each pair's collection (named by pair code as written from bitfinbatch_pandf) is read concurrently through
+    the arrow reader, and every pair is placed onto one shared time grid with a single vectorized scatter rather
+    than chained dataframe merges.
+
+    With cache on, panels are cached in memory by request key, and on disk as .npz under cache_dir if given. Only
+    complete windows are cached, those where every pair has a candle stored at or after upper_bound, so a window
+    reaching live data is always read fresh. Cached panels are shared between callers so their values are read
+    only. Candles backfilled into an already cached window are not seen until the cache is cleared.
+
+    :param pairs: list of string trading pair codes
+    :param mongodb_client: mongo client to connect to, shared by all workers
+    :param db_name: string database name holding one collection per pair
+    :param lower_bound: inclusive naive utc start of the window
+    :param upper_bound: exclusive naive utc end of the window
+    :param fields: candle fields to include from ['open', 'close', 'high', 'low', 'volume']
+    :param freq: bitfinex interval or pandas timedelta string of the grid e.g. 1m, 1h, candles are placed in the
+        interval containing their time and rolled up per field when several share an interval, see bucket_candles
+    :param ffill: forward fill gaps from each pair's last candle
+    :param max_staleness: do not forward fill a value further than this, unlimited if None
+    :param source: string source prefix of the collection columns
+    :param dtype: float dtype of the panel, np.float32 halves memory
+    :param max_workers: number of concurrent pair reads
+    :param cache: use and fill the panel cache, see above
+    :param cache_dir: Path type object pointing to a directory for the on disk panel cache
+    :return: Panel
+    """
+    import pandas as pd
+
+    pairs, fields = list(pairs), list(fields)
+    key = _panel_key(mongodb_client, pairs, db_name, lower_bound, upper_bound, fields, freq, ffill, max_staleness,
+                     source, np.dtype(dtype).str) if cache else None
+
+    if cache:
+        with _PANEL_CACHE_LOCK:
+            if key in _PANEL_CACHE:
+                _PANEL_CACHE.move_to_end(key)
+                return _PANEL_CACHE[key]
+
+        if cache_dir is not None and (pathlib.Path(cache_dir) / f'{key}.npz').exists():
+            with np.load(pathlib.Path(cache_dir) / f'{key}.npz') as cached:
+                panel = Panel(cached['values'], cached['times'], pairs, fields)
+            panel.values.flags.writeable = False
+            _cache_panel(key, panel)
+            return panel
+
+    step_ms = int(pd.Timedelta(freq).total_seconds() * 1000)
+    start_ms = int(pd.Timestamp(lower_bound).value // 1_000_000) // step_ms * step_ms
+    end_ms = int(pd.Timestamp(upper_bound).value // 1_000_000)
+    n_steps = max(-(-(end_ms - start_ms) // step_ms), 0)
+    times = (start_ms + step_ms * np.arange(n_steps)).astype('datetime64[ms]')
+
+    values = np.full((n_steps, len(pairs), len(fields)), np.nan, dtype=dtype)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_read_pair, mongodb_client, db_name, pair, source, fields,
+                                   lower_bound, upper_bound, cache) for pair in pairs]
+
+        complete = True
+        for i, future in enumerate(futures):
+            pair_times, pair_values, newest = future.result()
+            complete = complete and newest is not None and newest >= end_ms
+            steps = (pair_times - start_ms) // step_ms
+            inside = (steps >= 0) & (steps < n_steps)
+            steps, pair_values = bucket_candles(steps[inside], pair_values[inside], fields)
+            values[steps, i, :] = pair_values
+
+    if ffill and n_steps:
+        limit = None if max_staleness is None else int(max_staleness.total_seconds() * 1000) // step_ms
+        flat = values.reshape(n_steps, -1)
+        values = ffill_array(flat, limit=limit).astype(dtype, copy=False).reshape(values.shape)
+
+    panel = Panel(values, times, pairs, fields)
+
+    if cache and complete:
+        panel.values.flags.writeable = False
+        _cache_panel(key, panel)
+        if cache_dir is not None:
+            pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            np.savez(pathlib.Path(cache_dir) / f'{key}.npz', values=panel.values, times=panel.times)
+
+    logging.info(f"Built {n_steps} x {len(pairs)} x {len(fields)} panel from MongoDB:{db_name}")
+
+    return panel
+
+
+def _cache_panel(key: str, panel: Panel):
+    with _PANEL_CACHE_LOCK:
+        _PANEL_CACHE[key] = panel
+        _PANEL_CACHE.move_to_end(key)
+        while len(_PANEL_CACHE) > PANEL_CACHE_SIZE:
+            _PANEL_CACHE.popitem(last=False)
+
+
+def mongodb_panel_pandf(pairs: list,
+                        mongodb_client: MongoClient,
+                        db_name: str,
+                        lower_bound: datetime.datetime,
+                        upper_bound: datetime.datetime,
+                        fields: list = ('close',),
+                        freq: str = '1m',
+                        ffill: bool = True,
+                        max_staleness: datetime.timedelta = None,
+                        **kwargs) -> pd.DataFrame:
+    """
+    Fetch an aligned multi pair panel as a wide pandas dataframe indexed by time with (pair, field) columns,
+    see mongodb_panel
+    :param pairs: list of string trading pair codes
+    :param mongodb_client: mongo client to connect to
+    :param db_name: string database name holding one collection per pair
+    :param lower_bound: inclusive naive utc start of the window
+    :param upper_bound: exclusive naive utc end of the window
+    :param fields: candle fields to include
+    :param freq: bitfinex interval or pandas timedelta string of the grid
+    :param ffill: forward fill gaps from each pair's last candle
+    :param max_staleness: do not forward fill a value further than this, unlimited if None
+    :param kwargs: passed to mongodb_panel
+    :return: pandas dataframe
+    """
+    panel = mongodb_panel(pairs=pairs,
+                          mongodb_client=mongodb_client,
+                          db_name=db_name,
+                          lower_bound=lower_bound,
+                          upper_bound=upper_bound,
+                          fields=fields,
+                          freq=freq,
+                          ffill=ffill,
+                          max_staleness=max_staleness,
+                          **kwargs)
+
+    return panel.to_pandf()
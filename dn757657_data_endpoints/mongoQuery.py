@@ -0,0 +1,316 @@
+# range query layer for MongoDB collections, shared by the bounded read functions
+import logging
+import threading
+
+from typing import Iterator
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+from pymongo.cursor import Cursor
+from pymongo.errors import OperationFailure
+
+
+_SCHEMA_CACHE = {}  # (client id, collection full name) -> {field: python type}
+_INDEX_CACHE = set()  # (client id, collection full name, index keys) already ensured by this process
+_INDEX_DENIED = set()  # (client id, collection full name, index keys) this process may not create e.g. read only users
+_CACHE_LOCK = threading.Lock()
+
+
+def _collection_key(collection: Collection) -> tuple:
+    return id(collection.database.client), collection.full_name
+
+
+def mongodb_collection_schema(collection: Collection,
+                              refresh: bool = False) -> dict:
+    """
+    field types of a collection, sampled from a single document and cached per process so bounded reads do not
+    pay a find_one round trip each time
+
+    :param collection: pymongo collection
+    :param refresh: resample the collection even if cached
+    :return: dict of field name -> python type
+    """
+    key = _collection_key(collection)
+    with _CACHE_LOCK:
+        schema = _SCHEMA_CACHE.get(key)
+    if schema is not None and not refresh:
+        return schema
+
+    sample_record = collection.find_one()
+    if sample_record is None:
+        raise ValueError(f"No records in {collection.full_name}")
+
+    schema = {field: type(value) for field, value in sample_record.items()}
+    with _CACHE_LOCK:
+        _SCHEMA_CACHE[key] = schema
+
+    return schema
+
+
+def mongodb_check_bounds(collection: Collection,
+                         bound_col: str,
+                         lower_bound=None,
+                         upper_bound=None):
+    """
+    check bounds are ordered and of the same type as the existing data in bound_col, the cached schema is
+    resampled once before failing in case the collection changed since it was cached
+
+    :param collection: pymongo collection
+    :param bound_col: string field the bounds apply to
+    :param lower_bound: lower bound or None
+    :param upper_bound: upper bound or None
+    :return:
+    """
+    if lower_bound is not None and upper_bound is not None and upper_bound <= lower_bound:
+        raise ValueError(f"Upper bound must be greater than Lower bound.")
+
+    bounds = {'lower_bound': lower_bound, 'upper_bound': upper_bound}
+    bounds = {name: bound for name, bound in bounds.items() if bound is not None}
+    if not bounds:
+        return
+
+    for refresh in (False, True):
+        schema = mongodb_collection_schema(collection, refresh=refresh)
+        if bound_col not in schema:
+            if refresh:
+                raise KeyError(f"{bound_col} not found in {collection.full_name}")
+            continue
+
+        column_type = schema[bound_col]
+        mismatched = {name: bound for name, bound in bounds.items() if not isinstance(bound, column_type)}
+        if not mismatched:
+            return
+
+    name, bound = next(iter(mismatched.items()))
+    raise TypeError(f"{name} is of type {type(bound).__name__}, but should be {column_type.__name__}")
+
+
+def mongodb_rangefilter(bound_col: str,
+                        lower_bound=None,
+                        upper_bound=None,
+                        lower_op: str = '$gte',
+                        upper_op: str = '$lt') -> dict:
+    """
+    build a range filter on a single field, by default a half open [lower, upper) window
+
+    :param bound_col: string field the bounds apply to
+    :param lower_bound: lower bound, unbounded if None
+    :param upper_bound: upper bound, unbounded if None
+    :param lower_op: ['$gte', '$gt'] comparison for the lower bound
+    :param upper_op: ['$lt', '$lte'] comparison for the upper bound
+    :return: mongo filter document, empty if no bounds given
+    """
+    if lower_op not in ('$gte', '$gt'):
+        raise ValueError(f"lower_op must be in: {['$gte', '$gt'].__repr__()}")
+    if upper_op not in ('$lt', '$lte'):
+        raise ValueError(f"upper_op must be in: {['$lt', '$lte'].__repr__()}")
+
+    condition = {}
+    if lower_bound is not None:
+        condition[lower_op] = lower_bound
+    if upper_bound is not None:
+        condition[upper_op] = upper_bound
+
+    return {bound_col: condition} if condition else {}
+
+
+def mongodb_range_index(bound_col: str) -> list:
+    """
+    compound index used for range reads on bound_col, _id is included so keyset pages have a unique sort key
+    :param bound_col: string field the bounds apply to
+    :return: index keys as a list of (field, direction)
+    """
+    if bound_col == '_id':
+        return [('_id', ASCENDING)]
+    return [(bound_col, ASCENDING), ('_id', ASCENDING)]
+
+
+def mongodb_range_sort(bound_col: str,
+                       sort_dir: int = ASCENDING) -> list:
+    """
+    sort matching the range index of bound_col, so the sort is served by the index
+    :param bound_col: string field the bounds apply to
+    :param sort_dir: [1: asc, -1: desc] direction to sort data by bound_col
+    :return: sort as a list of (field, direction)
+    """
+    return [(field, sort_dir) for field, _ in mongodb_range_index(bound_col)]
+
+
+def mongodb_ensure_index(collection: Collection,
+                         keys: list,
+                         **kwargs) -> str:
+    """
+    create an index if it does not exist, remembered per process so only the first call costs a round trip
+    :param collection: pymongo collection
+    :param keys: index keys as a list of (field, direction)
+    :param kwargs: index options passed to create_index e.g. unique=True
+    :return: string index name
+    """
+    key = _collection_key(collection) + (tuple(keys), tuple(sorted(kwargs.items())))
+    name = '_'.join(f'{field}_{direction}' for field, direction in keys)  # mongo's default index naming
+
+    with _CACHE_LOCK:
+        if key in _INDEX_CACHE:
+            return name
+
+    name = collection.create_index(keys, **kwargs)  # no-op on the server if it already exists
+    with _CACHE_LOCK:
+        _INDEX_CACHE.add(key)
+
+    logging.info(f"Ensured index {name} on {collection.full_name}")
+
+    return name
+
+
+def mongodb_read_index(collection: Collection,
+                       keys: list) -> list:
+    """
+    ensure an index used to serve reads, read only users can not create indexes so a refused create is logged and
+    remembered rather than raised, the read then goes unhinted and mongo plans it from the indexes that exist
+    :param collection: pymongo collection
+    :param keys: index keys as a list of (field, direction)
+    :return: keys to hint, None if the index could not be ensured
+    """
+    key = _collection_key(collection) + (tuple(keys),)
+    with _CACHE_LOCK:
+        if key in _INDEX_DENIED:
+            return None
+
+    try:
+        mongodb_ensure_index(collection, keys)
+    except OperationFailure as e:
+        logging.info(f"Could not ensure index on {collection.full_name}, reading without a hint: {e}")
+        with _CACHE_LOCK:
+            _INDEX_DENIED.add(key)
+        return None
+
+    return keys
+
+
+def mongodb_rangecursor(collection: Collection,
+                        bound_col: str,
+                        lower_bound=None,
+                        upper_bound=None,
+                        lower_op: str = '$gte',
+                        upper_op: str = '$lt',
+                        sort_dir: int = ASCENDING,
+                        limit: int = -1,
+                        projection: dict = None,
+                        hint=None,
+                        ensure_index: bool = True,
+                        check_types: bool = True) -> Cursor:
+    """
+    cursor over a bounded window of a collection sorted on bound_col, the compound range index is created if
+    needed and hinted so wide windows are answered by an index scan rather than a collection scan
+
+    :param collection: pymongo collection
+    :param bound_col: string field the bounds apply to and the data is sorted by
+    :param lower_bound: lower bound, unbounded if None
+    :param upper_bound: upper bound, unbounded if None
+    :param lower_op: ['$gte', '$gt'] comparison for the lower bound
+    :param upper_op: ['$lt', '$lte'] comparison for the upper bound
+    :param sort_dir: [1: asc, -1: desc] direction to sort data by bound_col
+    :param limit: limit the number of returned entries, -1 for no limit
+    :param projection: mongo projection document
+    :param hint: index name or keys to hint, defaults to the range index when ensure_index is set and the index
+        could be ensured
+    :param ensure_index: create the range index on bound_col if this process has not already, see
+        mongodb_read_index
+    :param check_types: validate bound types against the cached collection schema
+    :return: pymongo cursor, call .explain() on it for the query plan
+    """
+    if check_types:
+        mongodb_check_bounds(collection, bound_col, lower_bound=lower_bound, upper_bound=upper_bound)
+
+    query = mongodb_rangefilter(bound_col, lower_bound=lower_bound, upper_bound=upper_bound,
+                                lower_op=lower_op, upper_op=upper_op)
+
+    if ensure_index:
+        keys = mongodb_read_index(collection, mongodb_range_index(bound_col))
+        if hint is None:
+            hint = keys
+
+    cursor = collection.find(query, projection).sort(mongodb_range_sort(bound_col, sort_dir))
+    if limit != -1:
+        cursor = cursor.limit(limit)
+    if hint is not None:
+        cursor = cursor.hint(hint)
+
+    return cursor
+
+
+def mongodb_explain_range(collection: Collection,
+                          bound_col: str,
+                          lower_bound=None,
+                          upper_bound=None,
+                          **kwargs) -> dict:
+    """
+    query plan for a bounded read, for diagnosing slow windows e.g. check for COLLSCAN stages
+    :param collection: pymongo collection
+    :param bound_col: string field the bounds apply to
+    :param lower_bound: lower bound, unbounded if None
+    :param upper_bound: upper bound, unbounded if None
+    :param kwargs: passed to mongodb_rangecursor
+    :return: explain output as dict
+    """
+    cursor = mongodb_rangecursor(collection, bound_col, lower_bound=lower_bound, upper_bound=upper_bound, **kwargs)
+
+    return cursor.explain()
+
+
+def mongodb_keyset_pages(collection: Collection,
+                         bound_col: str,
+                         lower_bound=None,
+                         upper_bound=None,
+                         lower_op: str = '$gte',
+                         upper_op: str = '$lt',
+                         sort_dir: int = ASCENDING,
+                         page_size: int = 10000,
+                         projection: dict = None,
+                         check_types: bool = True) -> Iterator[list]:
+    """
+    page through a bounded window using keyset pagination on (bound_col, _id), each page starts an index seek
+    after the last key of the previous one so deep pages cost the same as the first, unlike skip
+
+    :param collection: pymongo collection
+    :param bound_col: string field the bounds apply to and the data is sorted by
+    :param lower_bound: lower bound, unbounded if None
+    :param upper_bound: upper bound, unbounded if None
+    :param lower_op: ['$gte', '$gt'] comparison for the lower bound
+    :param upper_op: ['$lt', '$lte'] comparison for the upper bound
+    :param sort_dir: [1: asc, -1: desc] direction to page through the window
+    :param page_size: number of documents per page
+    :param projection: mongo projection document, _id is always returned as it is part of the key
+    :param check_types: validate bound types against the cached collection schema
+    :return: generator of lists of documents
+    """
+    if projection is not None and projection.get('_id', 1) == 0:
+        projection = {field: value for field, value in projection.items() if field != '_id'}
+
+    if check_types:
+        mongodb_check_bounds(collection, bound_col, lower_bound=lower_bound, upper_bound=upper_bound)
+
+    keys = mongodb_read_index(collection, mongodb_range_index(bound_col))
+
+    window = mongodb_rangefilter(bound_col, lower_bound=lower_bound, upper_bound=upper_bound,
+                                 lower_op=lower_op, upper_op=upper_op)
+    after = '$gt' if sort_dir == ASCENDING else '$lt'
+
+    last = None
+    while True:
+        query = window
+        if last is not None:
+            last_bound, last_id = last
+            seek = {'$or': [{bound_col: {after: last_bound}},
+                            {bound_col: last_bound, '_id': {after: last_id}}]}
+            query = {'$and': [window, seek]} if window else seek
+
+        cursor = collection.find(query, projection).sort(mongodb_range_sort(bound_col, sort_dir)).limit(page_size)
+        page = list(cursor if keys is None else cursor.hint(keys))
+        if not page:
+            return
+
+        yield page
+
+        if len(page) < page_size:
+            return
+        last = page[-1][bound_col], page[-1]['_id']
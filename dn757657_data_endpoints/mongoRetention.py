@@ -0,0 +1,276 @@
+# tiered retention for time series collections: raw data in mongo while hot, then rolled up and archived to parquet
+from __future__ import annotations
+
+import datetime
+import logging
+import pathlib
+
+from typing import TYPE_CHECKING
+from pymongo import MongoClient, ASCENDING, UpdateOne
+
+from dn757657_data_endpoints.mongoQuery import mongodb_ensure_index, mongodb_range_index, mongodb_rangecursor
+
+if TYPE_CHECKING:  # pandas is heavy, only import it when a function actually needs it
+    import pandas as pd
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+# how each candle column is rolled up, matched on the column name suffix from bitfinex_renamecols
+ROLLUP_AGGS = {'_open': 'first', '_close': 'last', '_high': 'max', '_low': 'min', '_volume': 'sum'}
+PARQUET_OPS = {'$gte': '>=', '$gt': '>', '$lt': '<', '$lte': '<='}
+
+
+class RetentionPolicy:
+    """
+    Retention policy for a single time series collection, e.g. keep 1m candles in mongo for 90 days, keep 1h
+    rollups forever in <collection>_1h, and archive the raw candles to parquet under
+        <archive_root>/<db_name>/<collection_name>/<batch start>.parquet
+    Data older than the hot period is processed in batch_span windows aligned to the epoch, so rollup intervals
+    should divide batch_span.
+    """
+
+    def __init__(self,
+                 time_col: str,
+                 hot: datetime.timedelta = datetime.timedelta(days=90),
+                 rollups: tuple = ('1h',),
+                 archive_root: pathlib.Path = None,
+                 batch_span: datetime.timedelta = datetime.timedelta(days=1),
+                 compression: str = 'zstd'):
+        """
+        :param time_col: string datetime column the policy ages data on e.g. bitfinex_btcusd_time
+        :param hot: how long raw data is kept in the collection
+        :param rollups: pandas frequency strings of rollup collections to maintain, may be empty
+        :param archive_root: Path type object pointing to the parquet archive root, raw data aged out of the
+            collection is dropped if None
+        :param batch_span: width of the time window processed per batch
+        :param compression: parquet compression codec for the archive
+        """
+        self.time_col = time_col
+        self.hot = hot
+        self.rollups = tuple(rollups)
+        self.archive_root = None if archive_root is None else pathlib.Path(archive_root)
+        self.batch_span = batch_span
+        self.compression = compression
+
+    def rollup_collection(self, collection_name: str, interval: str) -> str:
+        return f'{collection_name}_{interval}'
+
+    def archive_path(self, db_name: str, collection_name: str) -> pathlib.Path:
+        return self.archive_root / db_name / collection_name
+
+    def window_start(self, time: datetime.datetime) -> datetime.datetime:
+        # start of the batch window containing time
+        return EPOCH + ((time - EPOCH) // self.batch_span) * self.batch_span
+
+
+def candle_rollup(df: pd.DataFrame,
+                  time_col: str,
+                  interval: str) -> pd.DataFrame:
+    """
+    roll candles up to a coarser interval, open/close/high/low/volume columns are aggregated as candles and
+    anything else keeps its last value
+    :param df: pandas dataframe of candles, columns named per bitfinex_renamecols
+    :param time_col: string datetime column
+    :param interval: pandas frequency string e.g. 1h
+    :return: pandas dataframe with one row per non empty interval, time_col is the interval start
+    """
+    aggs = {}
+    for col in df.columns:
+        if col == time_col:
+            continue
+        aggs[col] = next((agg for suffix, agg in ROLLUP_AGGS.items() if col.endswith(suffix)), 'last')
+
+    df = df.sort_values(time_col)
+    rollup = df.groupby(df[time_col].dt.floor(interval)).agg(aggs)
+
+    return rollup.rename_axis(time_col).reset_index()
+
+
+def archive_pandf(policy: RetentionPolicy,
+                  db_name: str,
+                  collection_name: str,
+                  lower_bound: datetime.datetime = None,
+                  upper_bound: datetime.datetime = None,
+                  lower_op: str = '$gte',
+                  upper_op: str = '$lt') -> pd.DataFrame:
+    """
+    Fetch archived raw data within bounds, parquet row group statistics are used to skip data outside the bounds
+    :param policy: retention policy the collection was archived under
+    :param db_name: string database name
+    :param collection_name: string collection name
+    :param lower_bound: lower bound on policy.time_col, unbounded if None
+    :param upper_bound: upper bound on policy.time_col, unbounded if None
+    :param lower_op: ['$gte', '$gt'] comparison for the lower bound
+    :param upper_op: ['$lt', '$lte'] comparison for the upper bound
+    :return: pandas dataframe, empty if nothing is archived
+    """
+    import pandas as pd
+    import pyarrow.parquet as pq
+
+    if policy.archive_root is None:
+        return pd.DataFrame()
+    path = policy.archive_path(db_name, collection_name)
+    if not path.exists() or not any(path.glob('*.parquet')):
+        return pd.DataFrame()
+
+    filters = []
+    if lower_bound is not None:
+        filters.append((policy.time_col, PARQUET_OPS[lower_op], lower_bound))
+    if upper_bound is not None:
+        filters.append((policy.time_col, PARQUET_OPS[upper_op], upper_bound))
+
+    table = pq.read_table(path, filters=filters or None)
+
+    return table.to_pandas()
+
+
+def _retention_batch(collection,
+                     policy: RetentionPolicy,
+                     db_name: str,
+                     start: datetime.datetime,
+                     end: datetime.datetime) -> int:
+    # age out one [start, end) window: archive, roll up, then delete exactly the documents that were read
+    import pandas as pd
+
+    time_col = policy.time_col
+    cursor = mongodb_rangecursor(collection, time_col, lower_bound=start, upper_bound=end,
+                                 sort_dir=ASCENDING, check_types=False)
+    df = pd.DataFrame(list(cursor))
+    if df.empty:
+        return 0
+
+    ids = df['_id'].tolist()
+    df = df.drop('_id', axis=1)
+    window = df
+
+    if policy.archive_root is not None:
+        # merge with anything archived for this window by an earlier run, so the file and the rollups below
+        # always reflect every raw record of the window
+        path = policy.archive_path(db_name, collection.name)
+        path.mkdir(parents=True, exist_ok=True)
+        file = path / f'{start:%Y%m%dT%H%M%S}.parquet'
+        if file.exists():
+            window = pd.concat([pd.read_parquet(file), df], ignore_index=True)
+        window = window.drop_duplicates(subset=time_col, keep='last').sort_values(time_col)
+        window.to_parquet(file, index=False, compression=policy.compression)
+
+    for interval in policy.rollups:
+        rollup_collection = collection.database[policy.rollup_collection(collection.name, interval)]
+        mongodb_ensure_index(rollup_collection, mongodb_range_index(time_col))
+
+        rollup = candle_rollup(window, time_col, interval)
+        requests = []
+        for record in rollup.to_dict('records'):
+            record[time_col] = record[time_col].to_pydatetime()
+            requests.append(UpdateOne({time_col: record[time_col]}, {'$set': record}, upsert=True))
+        rollup_collection.bulk_write(requests, ordered=False)
+
+    collection.delete_many({'_id': {'$in': ids}})
+
+    return len(ids)
+
+
+def mongodb_retention(mongodb_client: MongoClient,
+                      db_name: str,
+                      collection_name: str,
+                      policy: RetentionPolicy,
+                      now: datetime.datetime = None,
+                      max_batches: int = None) -> int:
+    """
+    Apply a retention policy to a collection, data older than policy.hot is archived, rolled up and removed one
+    batch window at a time, so no long running operation holds the collection. Each window is archived and rolled
+    up before its documents are deleted, and rerunning a window rewrites the same archive file and rollup
+    documents, so an interrupted run is safe to repeat. Intended to be run periodically e.g. from airflow.
+
+    :param mongodb_client: mongo client to connect to
+    :param db_name: string database name
+    :param collection_name: string collection name
+    :param policy: retention policy to apply
+    :param now: naive utc datetime the hot period is measured back from, defaults to the current time
+    :param max_batches: stop after this many windows, process everything aged out if None
+    :return: number of documents aged out of the collection
+    """
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    cutoff = policy.window_start(now - policy.hot)
+
+    collection = mongodb_client[db_name][collection_name]
+    time_col = policy.time_col
+    mongodb_ensure_index(collection, mongodb_range_index(time_col))
+
+    n_aged = 0
+    n_batches = 0
+    while max_batches is None or n_batches < max_batches:
+        oldest = collection.find_one({time_col: {'$lt': cutoff}}, {time_col: 1}, sort=[(time_col, ASCENDING)])
+        if oldest is None:
+            break
+
+        start = policy.window_start(oldest[time_col])
+        end = start + policy.batch_span
+        n_aged += _retention_batch(collection, policy, db_name, start, end)
+        n_batches += 1
+
+    logging.info(f"Aged {n_aged} Records out of MongoDB:{db_name}:{collection_name} in {n_batches} batches")
+
+    return n_aged
+
+
+def mongodb_tiered_pandf(db_name: str,
+                         mongodb_client: MongoClient,
+                         collection_name: str,
+                         policy: RetentionPolicy,
+                         lower_bound: datetime.datetime = None,
+                         upper_bound: datetime.datetime = None,
+                         interval: str = None) -> pd.DataFrame:
+    """
+    Fetch a [lower_bound, upper_bound) window of a collection under a retention policy, stitching the tiers
+    together so the result does not depend on how much has been aged out.
+        interval None: raw data from the parquet archive and the hot collection
+        interval in policy.rollups: the rollup collection, plus the hot collection rolled up on the fly
+    :param db_name: string database name
+    :param mongodb_client: mongo client to connect to
+    :param collection_name: string collection name
+    :param policy: retention policy the collection is managed under
+    :param lower_bound: inclusive lower bound on policy.time_col
+    :param upper_bound: exclusive upper bound on policy.time_col
+    :param interval: rollup interval to read, raw data if None
+    :return: pandas dataframe sorted ascending by policy.time_col
+    """
+    import pandas as pd
+
+    if lower_bound is not None and upper_bound is not None and upper_bound <= lower_bound:
+        raise ValueError(f"Upper bound must be greater than Lower bound.")
+
+    time_col = policy.time_col
+    db = mongodb_client[db_name]
+
+    def read(name):
+        # no type check, either tier may be empty e.g. no rollups yet or everything aged out
+        cursor = mongodb_rangecursor(db[name], time_col, lower_bound=lower_bound, upper_bound=upper_bound,
+                                     sort_dir=ASCENDING, check_types=False)
+        df = pd.DataFrame(list(cursor))
+        return df.drop('_id', axis=1) if not df.empty else df
+
+    hot = read(collection_name)
+
+    if interval is None:
+        tiers = [archive_pandf(policy, db_name, collection_name, lower_bound=lower_bound, upper_bound=upper_bound),
+                 hot]
+    elif interval in policy.rollups:
+        if not hot.empty:
+            hot = candle_rollup(hot, time_col, interval)
+        # hot data is rolled up last so a bucket split across the cutoff takes the freshest aggregate
+        tiers = [read(policy.rollup_collection(collection_name, interval)), hot]
+    else:
+        raise ValueError(f"interval must be None or in: {list(policy.rollups).__repr__()}")
+
+    tiers = [tier for tier in tiers if not tier.empty]
+    if not tiers:
+        return pd.DataFrame()
+
+    df = pd.concat(tiers, ignore_index=True)
+    df = df.drop_duplicates(subset=time_col, keep='last').sort_values(time_col, ignore_index=True)
+
+    logging.info(f"Loaded {len(df)} Records from MongoDB:{db_name}:{collection_name} across retention tiers")
+
+    return df
@@ -0,0 +1,255 @@
+# write-behind buffered writes to MongoDB, for pushing records from per event code paths
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+
+_FLUSH = object()  # queue markers for the writer thread
+_CLOSE = object()
+
+_WRITERS = {}  # (client id, db name, collection name) -> MongoBufferedWriter, see dict_mongodb_buffered
+_WRITERS_LOCK = threading.Lock()
+
+
+class MongoBufferedWriter:
+    """
+    Collects records and writes them to a collection with insert_many on a background thread, a batch is written
+    once it reaches max_batch records or its oldest record is max_age seconds old. At most max_pending records are
+    held in memory, when mongo falls behind write() blocks (or drops the record if block=False) instead of growing
+    without bound. Buffered records are flushed on close() and at interpreter exit. A batch that cannot be written
+    e.g. holding a record bson cannot encode is retried record by record, only the records that fail are logged and
+    dropped, it never stops the writer.
+
+    usage:
+        with MongoBufferedWriter(mongodb_client, db_name, collection_name) as writer:
+            writer.write(record)
+    """
+
+    def __init__(self,
+                 mongodb_client: MongoClient,
+                 db_name: str,
+                 collection_name: str,
+                 max_batch: int = 1000,
+                 max_age: float = 1.0,
+                 max_pending: int = 100000,
+                 block: bool = True,
+                 retries: int = 3):
+        """
+        :param mongodb_client: mongo client to connect to
+        :param db_name: string name of the database to push data into
+        :param collection_name: string name of the collection to push data into
+        :param max_batch: number of records per insert_many
+        :param max_age: seconds a record may wait in the buffer before its batch is written
+        :param max_pending: number of records buffered before write() blocks or drops
+        :param block: block write() when the buffer is full, otherwise drop and count the record
+        :param retries: attempts per batch on connection errors before the batch is dropped
+        """
+        self.db_name = db_name
+        self.collection_name = collection_name
+        self.collection = mongodb_client[db_name][collection_name]
+        self.max_batch = max_batch
+        self.max_age = max_age
+        self.block = block
+        self.retries = retries
+
+        self.written = 0
+        self.dropped = 0
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f'mongo-writer-{db_name}.{collection_name}',
+                                        daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, data: dict) -> bool:
+        """
+        buffer a record for writing, empty records will be ignored
+        :param data: record to push to the collection
+        :return: True if buffered, False if dropped because the buffer was full or the writer is closed
+        """
+        if not data:
+            return True
+        if self._closed or not self._thread.is_alive():
+            logging.info(f"Dropped record for closed writer MongoDB:{self.db_name}:{self.collection_name}")
+            self.dropped += 1
+            return False
+
+        if self.block:
+            buffered = self._put(data)
+        else:
+            try:
+                self._queue.put_nowait(data)
+                buffered = True
+            except queue.Full:
+                buffered = False
+
+        if not buffered:
+            self.dropped += 1
+
+        return buffered
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        write everything buffered so far
+        :param timeout: seconds to wait, wait indefinitely if None
+        :return: True if flushed before the timeout
+        """
+        if self._closed:
+            return not self._thread.is_alive()
+
+        done = threading.Event()
+        if not self._put((_FLUSH, done)):
+            return False
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not done.wait(0.5 if deadline is None else min(max(deadline - time.monotonic(), 0), 0.5)):
+            if not self._thread.is_alive() or deadline is not None and time.monotonic() >= deadline:
+                return done.is_set()
+
+        return True
+
+    def close(self, timeout: float = None):
+        """
+        flush and stop the writer thread, further writes are dropped
+        :param timeout: seconds to wait for the final flush, wait indefinitely if None
+        :return:
+        """
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+
+        if self._put(_CLOSE):
+            self._thread.join(timeout)
+        else:  # writer thread is gone, nothing left to write what is buffered
+            self.dropped += self._queue.qsize()
+
+        logging.info(f"Closed writer for MongoDB:{self.db_name}:{self.collection_name}, "
+                     f"{self.written} written, {self.dropped} dropped")
+
+    def _put(self, item) -> bool:
+        # blocking put that gives up if the writer thread has stopped, so callers never wait on a full queue forever
+        while self._thread.is_alive():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None  # oldest buffered record reached max_age
+
+            if item is None or item is _CLOSE or isinstance(item, tuple) and item[0] is _FLUSH:
+                self._insert(batch)
+                batch, deadline = [], None
+                if item is _CLOSE:
+                    return
+                if item is not None:
+                    item[1].set()
+                continue
+
+            batch.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + self.max_age
+            if len(batch) >= self.max_batch:
+                self._insert(batch)
+                batch, deadline = [], None
+
+    def _insert(self, batch: list):
+        if not batch:
+            return
+
+        for attempt in range(1, self.retries + 1):
+            try:
+                self.collection.insert_many(batch, ordered=False)
+                self.written += len(batch)
+                logging.info(f"Loaded {len(batch)} Records into MongoDB:{self.db_name}:{self.collection_name}")
+                return
+
+            except BulkWriteError as e:  # e.g. duplicate keys, the rest of the batch was still written
+                errors = e.details.get('writeErrors', [])
+                if attempt > 1:  # records already written by an attempt that failed before it was acknowledged
+                    errors = [error for error in errors if error.get('code') != 11000]
+                n_errors = len(errors)
+                self.written += len(batch) - n_errors
+                self.dropped += n_errors
+                if n_errors:
+                    logging.info(f"{n_errors} Records rejected by MongoDB:{self.db_name}:{self.collection_name}")
+                return
+
+            except PyMongoError as e:
+                logging.info(f"Write to MongoDB:{self.db_name}:{self.collection_name} failed "
+                             f"({attempt}/{self.retries}): {e}")
+                if attempt < self.retries:
+                    time.sleep(min(2 ** attempt, 30))
+
+            except Exception as e:  # e.g. bson.errors.InvalidDocument, retrying will not help
+                logging.info(f"Write to MongoDB:{self.db_name}:{self.collection_name} failed, "
+                             f"inserting {len(batch)} Records one by one: {e!r}")
+                self._insert_each(batch)
+                return
+
+        self.dropped += len(batch)
+
+    def _insert_each(self, batch: list):
+        # fallback for a batch insert_many can not send, so only the records that can not be written are dropped
+        for record in batch:
+            try:
+                self.collection.insert_one(record)
+                self.written += 1
+
+            except DuplicateKeyError:  # sent by insert_many before it hit the bad record
+                self.written += 1
+
+            except Exception as e:
+                self.dropped += 1
+                logging.info(f"Dropped Record for MongoDB:{self.db_name}:{self.collection_name}: {e!r}")
+
+
+def dict_mongodb_buffered(data: dict,
+                          db_name: str,
+                          collection_name: str,
+                          mongodb_client: MongoClient, ):
+    """
+    Buffered drop in for dict_mongodb, records are written in batches in the background by a MongoBufferedWriter
+    shared per (client, database, collection) and created with default settings on first use
+    All datasets of a given format should be included in a single database, delineated by collections
+    :param data: record to push to db, empty records will be ignored
+    :param db_name: string name of the database to push data into
+    :param collection_name: string name of the collection to push data into
+    :param mongodb_client: mongo client to connect to
+    :return:
+    """
+
+    if data:
+        key = (id(mongodb_client), db_name, collection_name)
+        with _WRITERS_LOCK:
+            writer = _WRITERS.get(key)
+            if writer is None or writer._closed:
+                writer = MongoBufferedWriter(mongodb_client, db_name, collection_name)
+                _WRITERS[key] = writer
+
+        writer.write(data)
+
+    return
@@ -0,0 +1,341 @@
+# functions for ingesting financial news from RSS/Atom feeds
+import datetime
+import email.utils
+import hashlib
+import logging
+import pathlib
+import queue
+import re
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterator
+from pymongo import MongoClient
+
+
+NEWS_DB_NAME = 'news'
+NEWS_COLLECTION_NAME = 'articles'
+_WHITESPACE = re.compile(r'\s+')
+_TAGS = re.compile(r'<[^>]+>')
+
+
+def _local_tag(tag: str) -> str:
+    # strip the xml namespace e.g. {http://www.w3.org/2005/Atom}entry -> entry
+    return tag.rsplit('}', 1)[-1]
+
+
+def normalize_text(text: str) -> str:
+    """
+    normalize text for content hashing, so the same story syndicated with different markup or spacing matches
+    :param text: string possibly containing html
+    :return: lowercase string with tags removed and whitespace collapsed
+    """
+    return _WHITESPACE.sub(' ', _TAGS.sub(' ', text or '')).strip().lower()
+
+
+def article_content_hash(title: str, summary: str) -> str:
+    """
+    :param title: string article title
+    :param summary: string article summary
+    :return: hex sha1 of the normalized title and summary
+    """
+    return hashlib.sha1(f'{normalize_text(title)}\n{normalize_text(summary)}'.encode()).hexdigest()
+
+
+def _parse_datetime(text: str) -> datetime.datetime:
+    # RFC 822 (rss) or ISO 8601 (atom) to naive utc, as stored in mongo
+    if not text:
+        return None
+    text = text.strip()
+    try:
+        value = email.utils.parsedate_to_datetime(text)
+    except (TypeError, ValueError):
+        try:
+            value = datetime.datetime.fromisoformat(text.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return value
+
+
+class FeedSource:
+    """
+    A source of news articles. Subclass and override open() to fetch from somewhere new, and parse() to read a
+    new format, the default parse() reads RSS 2.0 and Atom.
+    """
+
+    def __init__(self, name: str, url: str, timeout: float = 30):
+        """
+        :param name: string source name stored with each article e.g. reuters_markets
+        :param url: http(s) url, file:// url or local path of the feed, local files are used for fixture feeds
+        :param timeout: seconds to wait on the http connection
+        """
+        self.name = name
+        self.url = url
+        self.timeout = timeout
+
+    def open(self) -> BinaryIO:
+        """
+        :return: binary stream of the raw feed, read incrementally by parse()
+        """
+        if self.url.startswith(('http://', 'https://')):
+            import requests
+
+            response = requests.get(self.url, stream=True, timeout=self.timeout,
+                                    headers={'accept': 'application/rss+xml, application/atom+xml, */*'})
+            response.raise_for_status()
+            response.raw.decode_content = True  # undo gzip etc as the stream is read
+            return response.raw
+
+        path = self.url[len('file://'):] if self.url.startswith('file://') else self.url
+        return open(pathlib.Path(path), 'rb')
+
+    def parse(self, stream: BinaryIO) -> Iterator[dict]:
+        """
+        parse articles from a feed as it is read, each item is removed from the tree once converted so memory use
+        does not grow with the size of the feed
+        :param stream: binary stream of the raw feed
+        :return: generator of article dicts, see rssitem_dict
+        """
+        parents = []  # elements open at the current parse position, the last is the parent of the next element
+        for event, elem in ET.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                parents.append(elem)
+                continue
+
+            parents.pop()
+            if _local_tag(elem.tag) in ('item', 'entry'):
+                yield rssitem_dict(elem, source=self.name)
+                if parents:  # detach from <channel> or <feed>, clearing alone leaves an empty element per item
+                    parents[-1].remove(elem)
+
+    def articles(self) -> Iterator[dict]:
+        """
+        :return: generator of article dicts fetched from this source
+        """
+        stream = self.open()
+        try:
+            yield from self.parse(stream)
+        finally:
+            stream.close()
+
+
+def rssitem_dict(elem: ET.Element, source: str) -> dict:
+    """
+    convert an RSS <item> or Atom <entry> element to an article record
+    :param elem: xml element of the item
+    :param source: string source name
+    :return: dict with article_id, content_hash, source, title, link, summary, published and fetched
+    """
+    fields = {}
+    for child in elem:
+        tag = _local_tag(child.tag)
+        if tag == 'link' and child.get('href') is not None:
+            if child.get('rel', 'alternate') == 'alternate':
+                fields.setdefault('link', child.get('href'))
+        elif tag in ('summary', 'description', 'content'):
+            if child.text and 'summary' not in fields:  # prefer the first of summary/description/content
+                fields['summary'] = child.text
+        elif child.text is not None:
+            fields.setdefault(tag, child.text.strip())
+
+    title = fields.get('title', '')
+    link = fields.get('link', '')
+    summary = fields.get('summary', '')
+    guid = fields.get('guid') or fields.get('id') or link or title
+
+    return {
+        'article_id': hashlib.sha1(f'{source}\n{guid}'.encode()).hexdigest(),
+        'content_hash': article_content_hash(title, summary),
+        'source': source,
+        'title': title,
+        'link': link,
+        'summary': summary,
+        'published': _parse_datetime(fields.get('pubDate') or fields.get('published') or fields.get('updated')),
+        'fetched': datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None),
+    }
+
+
+class SeenIndex:
+    """
+    Persistent set of article content hashes, backed by sqlite so it survives restarts and is shared by runs on the
+    same machine. Hashes seen by this process are also held in memory so repeat checks skip the database.
+    """
+
+    def __init__(self, path: pathlib.Path = None):
+        """
+        :param path: Path type object pointing to the sqlite file, in memory only if None
+        """
+        self._conn = sqlite3.connect(':memory:' if path is None else str(path), check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS seen (content_hash TEXT PRIMARY KEY)')
+        self._conn.commit()
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def unseen(self, hashes: list) -> set:
+        """
+        :param hashes: list of content hashes
+        :return: set of the hashes not seen before
+        """
+        with self._lock:
+            candidates = set(hashes) - self._seen
+            unseen = set(candidates)
+            candidates = list(candidates)
+            for i in range(0, len(candidates), 500):  # stay under sqlite's bound parameter limit
+                chunk = candidates[i:i + 500]
+                rows = self._conn.execute(f'SELECT content_hash FROM seen WHERE content_hash IN '
+                                          f'({",".join("?" * len(chunk))})', chunk)
+                found = {row[0] for row in rows}
+                unseen -= found
+                self._seen.update(found)
+
+        return unseen
+
+    def add(self, hashes: list):
+        """
+        record hashes as seen
+        :param hashes: list of content hashes
+        :return:
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.executemany('INSERT OR IGNORE INTO seen (content_hash) VALUES (?)',
+                                       [(content_hash,) for content_hash in hashes])
+            self._seen.update(hashes)
+
+    def close(self):
+        self._conn.close()
+
+
+def newsfeeds_dicts(sources: list,
+                    seen_index: SeenIndex = None,
+                    max_workers: int = 16,
+                    mark_seen: bool = True,
+                    chunk_size: int = 500) -> Iterator[list]:
+    """
+    Fetch and parse many feed sources concurrently, dropping articles whose content has been seen before or
+    already came from another source in this call. Articles are handed over from the fetching threads in chunks as
+    each feed is parsed, through a bounded queue, so no feed is ever held in memory whole.
+    :param sources: list of FeedSource
+    :param seen_index: SeenIndex used to drop duplicates, an in memory index for this call if None
+    :param max_workers: number of sources fetched at once
+    :param mark_seen: record yielded articles in seen_index, turn off to record them only once they are stored
+    :param chunk_size: number of parsed articles handed over at a time
+    :return: generator of non empty lists of new article dicts
+    """
+    if seen_index is None:
+        seen_index = SeenIndex()
+    yielded = set()  # content hashes yielded by this call
+    chunks = queue.Queue(maxsize=max_workers * 2)  # (source, articles, done, error), parsing waits on a slow consumer
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch(source):
+        # runs on a worker thread, a failed feed is reported with its last chunk rather than raised
+        articles, chunk, error = None, [], None
+        try:
+            articles = source.articles()
+            for article in articles:
+                chunk.append(article)
+                if len(chunk) >= chunk_size:
+                    if not put((source, chunk, False, None)):
+                        return
+                    chunk = []
+        except Exception as e:  # one broken feed should not stop the rest
+            error = e
+        finally:
+            if articles is not None:
+                articles.close()
+
+        put((source, chunk, True, error))
+
+    counts = {source: [0, 0] for source in sources}  # fetched, new
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for source in sources:
+            executor.submit(fetch, source)
+
+        try:
+            remaining = len(sources)
+            while remaining:
+                source, articles, done, error = chunks.get()
+
+                unique = {article['content_hash']: article for article in articles
+                          if article['content_hash'] not in yielded}
+                new = seen_index.unseen(list(unique))
+                if mark_seen:
+                    seen_index.add(list(new))
+                yielded.update(new)
+
+                counts[source][0] += len(articles)
+                counts[source][1] += len(new)
+                if done:
+                    remaining -= 1
+                    fetched, n_new = counts[source]
+                    if error is not None:
+                        logging.info(f'Failed to fetch news from {source.name} after {fetched} articles: {error!r}')
+                    else:
+                        logging.info(f'Fetched {fetched} articles from {source.name}, {n_new} new')
+
+                if new:
+                    yield [article for content_hash, article in unique.items() if content_hash in new]
+        finally:
+            stop.set()  # release workers blocked on a full queue if the consumer stopped early
+
+
+def newsfeeds_mongodb(sources: list,
+                      mongodb_client: MongoClient,
+                      db_name: str = NEWS_DB_NAME,
+                      collection_name: str = NEWS_COLLECTION_NAME,
+                      seen_index: SeenIndex = None,
+                      max_workers: int = 16,
+                      batch_size: int = 1000) -> int:
+    """
+    Ingest news from many feed sources into mongo, new articles are bulk upserted on article_id so reruns and
+    overlapping feeds never store an article twice
+    :param sources: list of FeedSource
+    :param mongodb_client: mongo client to connect to
+    :param db_name: string name of the database to push data into
+    :param collection_name: string name of the collection to push data into
+    :param seen_index: SeenIndex used to drop duplicates, pass a persistent one to dedup across runs
+    :param max_workers: number of sources fetched at once
+    :param batch_size: number of articles per bulk write
+    :return: number of articles stored
+    """
+    from dn757657_data_endpoints.mongoDB import dicts_mongodb_upsert
+
+    if seen_index is None:
+        seen_index = SeenIndex()
+
+    def store(articles):
+        n_inserted = dicts_mongodb_upsert(articles, db_name, collection_name, mongodb_client,
+                                          key='article_id', batch_size=batch_size)
+        # only marked seen once stored, so a failed write is retried on the next run
+        seen_index.add([article['content_hash'] for article in articles])
+        return n_inserted
+
+    n_stored = 0
+    pending = []
+    for articles in newsfeeds_dicts(sources, seen_index=seen_index, max_workers=max_workers, mark_seen=False):
+        pending.extend(articles)
+        if len(pending) >= batch_size:
+            n_stored += store(pending)
+            pending = []
+
+    if pending:
+        n_stored += store(pending)
+
+    logging.info(f'Stored {n_stored} articles from {len(sources)} news sources')
+
+    return n_stored
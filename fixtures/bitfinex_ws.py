@@ -0,0 +1,62 @@
+# fake bitfinex websocket server for testing BitfinCandleStream without the network
+import asyncio
+import json
+
+
+class FakeBitfinexServer:
+    """
+    Speaks enough of the bitfinex v2 websocket protocol to drive BitfinCandleStream. Each connection is served the
+    next script in sessions, a list of (key, payload) frames sent once every key the client asks for is subscribed.
+    The connection is dropped when its script runs out, the last script is reused for any further connections.
+
+    usage:
+        async with FakeBitfinexServer([[('trade:1m:tBTCUSD', snapshot), ...], ...]) as server:
+            stream = BitfinCandleStream(['btcusd'], on_closed=..., url=server.url)
+    """
+
+    def __init__(self, sessions: list, host: str = '127.0.0.1', frame_delay: float = 0.01):
+        """
+        :param sessions: list of per connection scripts, each a list of (channel key, payload) frames
+        :param host: interface to listen on, a free port is picked
+        :param frame_delay: seconds between frames, so the client handles them as separate messages
+        """
+        self.sessions = sessions
+        self.host = host
+        self.frame_delay = frame_delay
+        self.connections = 0
+        self.url = None
+        self._server = None
+
+    async def __aenter__(self):
+        import websockets
+
+        self._server = await websockets.serve(self._handler, self.host, 0)
+        port = next(iter(self._server.sockets)).getsockname()[1]
+        self.url = f'ws://{self.host}:{port}'
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handler(self, ws, *args):  # websockets < 10.1 also passes the request path
+        script = self.sessions[min(self.connections, len(self.sessions) - 1)]
+        self.connections += 1
+
+        await ws.send(json.dumps({'event': 'info', 'version': 2}))
+
+        keys = {key for key, _ in script}
+        channels = {}
+        while not keys <= set(channels):
+            msg = json.loads(await ws.recv())
+            if msg.get('event') == 'subscribe':
+                channels[msg['key']] = len(channels) + 1
+                await ws.send(json.dumps({'event': 'subscribed', 'channel': 'candles',
+                                          'chanId': channels[msg['key']], 'key': msg['key']}))
+
+        for key, payload in script:
+            await asyncio.sleep(self.frame_delay)
+            await ws.send(json.dumps([channels[key], payload]))
+
+        await asyncio.sleep(self.frame_delay)
+        await ws.close()
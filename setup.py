@@ -11,6 +11,6 @@ setup(
     author_email="dn757657@dal.ca",
     install_requires=requirements,
     packages=find_packages(include=['dn757657_crypto_num_sources',
-                                    'dn757657_data_endpoints'],
-                           exclude=['dn757657_fin_news_sources']),  # package = any folder with an __init__.py file
+                                    'dn757657_data_endpoints',
+                                    'dn757657_fin_news_sources']),  # package = any folder with an __init__.py file
 )
@@ -0,0 +1,105 @@
+# checks BitfinCandleStream against the fake bitfinex websocket server in fixtures, no network needed
+# run with: python test_bitfinstream.py
+import asyncio
+import datetime
+import socket
+
+import pandas as pd
+
+import dn757657_crypto_num_sources.bitfinStream as bitfinStream
+
+from dn757657_crypto_num_sources.bitfinStream import BitfinCandleStream, bitfin_candle_key
+from fixtures.bitfinex_ws import FakeBitfinexServer
+
+T0 = 1_690_000_020_000  # unix ms, on a minute boundary
+MINUTE = 60_000
+KEY = bitfin_candle_key('btcusd')
+
+
+def candle(i: int, close: float = None) -> list:
+    # raw [mts, open, close, high, low, volume] candle for the i-th minute after T0
+    price = 100.0 + i
+    return [T0 + i * MINUTE, price, price if close is None else close, price + 1, price - 1, 10.0 + i]
+
+
+def rest_pandf(calls: list):
+    # stub for bitfin_pandf serving minutes 0-20 newest first, fails the first call like a bad REST response would
+    def bitfin_pandf(pair_code, interval, start, end, **kwargs):
+        calls.append((start, end))
+        if len(calls) == 1:
+            raise ValueError('bad REST response')
+
+        start_ms, end_ms = int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+        rows = [candle(i) for i in range(20, -1, -1) if start_ms <= T0 + i * MINUTE <= end_ms]
+        df = pd.DataFrame(rows, columns=['time', 'open', 'close', 'high', 'low', 'volume'])
+        df['time'] = pd.to_datetime(df['time'], unit='ms')
+        return df
+
+    return bitfin_pandf
+
+
+async def run_stream() -> tuple:
+    sessions = [
+        # snapshot with minute 4 trading, an update of minute 4, then minute 5 opens and closes minute 4
+        [(KEY, [candle(i) for i in range(4, -1, -1)]), (KEY, candle(4, close=150.0)), (KEY, candle(5))],
+        # after the drop minutes 5-8 were missed, the snapshot starts at 9 and the first backfill attempt fails
+        [(KEY, [candle(i) for i in range(12, 8, -1)])],
+    ]
+    closed = []
+    calls = []
+    bitfin_pandf = bitfinStream.bitfin_pandf
+    bitfinStream.bitfin_pandf = rest_pandf(calls)
+
+    try:
+        async with FakeBitfinexServer(sessions) as server:
+            stream = BitfinCandleStream(['btcusd'], on_closed=lambda pair, record: closed.append(record),
+                                        url=server.url, max_reconnect_delay=0.2)
+            task = asyncio.ensure_future(stream.run())
+
+            for _ in range(200):
+                if len(closed) >= 8:
+                    break
+                await asyncio.sleep(0.05)
+
+            stream.stop()
+            await asyncio.wait_for(task, 5)
+    finally:
+        bitfinStream.bitfin_pandf = bitfin_pandf
+
+    return closed, calls, server.connections, stream
+
+
+def test_stream_snapshot_close_reconnect_backfill():
+    closed, calls, connections, stream = asyncio.run(run_stream())
+    times = [record['bitfinex_btcusd_time'] for record in closed]
+    expected = [datetime.datetime(2023, 7, 22, 4, 27) + datetime.timedelta(minutes=i) for i in range(4, 12)]
+
+    # minute 4 closes live with its last update, 5-8 are backfilled, 9-11 close from the second snapshot
+    assert times == expected, times
+    assert closed[0]['bitfinex_btcusd_close'] == 150.0
+    assert [record['bitfinex_btcusd_close'] for record in closed[1:]] == [100.0 + i for i in range(5, 12)]
+    assert connections >= 3  # dropped once by the server, once by the failed backfill
+    assert len(calls) == 2
+    assert stream.open_candle('btcusd')['bitfinex_btcusd_open'] == 112.0
+
+
+async def stop_during_backoff():
+    with socket.socket() as sock:  # a port nothing listens on, every connect fails and backs off
+        sock.bind(('127.0.0.1', 0))
+        url = f'ws://127.0.0.1:{sock.getsockname()[1]}'
+
+    stream = BitfinCandleStream(['btcusd'], on_closed=lambda pair, record: None, url=url)
+    task = asyncio.ensure_future(stream.run())
+    await asyncio.sleep(0.2)
+    stream.stop()
+    await asyncio.wait_for(task, 0.5)  # the first backoff is 1s
+
+
+def test_stop_during_backoff():
+    asyncio.run(stop_during_backoff())
+
+
+if __name__ == '__main__':
+    test_stream_snapshot_close_reconnect_backfill()
+    test_stop_during_backoff()
+    print('ok')